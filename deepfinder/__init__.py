@@ -25,8 +25,10 @@
 # **************************************************************************
 import os
 import pwem
+from pyworkflow import Config
 from pyworkflow.utils import Environ
 from .constants import *
+from .scripts import getScript
 
 
 __version__ = '3.2.2'
@@ -43,6 +45,7 @@ class Plugin(pwem.Plugin):
     def _defineVariables(cls):
         cls._defineEmVar(DF_HOME, DF_FOLDER + '-' + DF_VERSION)
         cls._defineVar(DF_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
+        cls._defineVar(DF_CACHE_DIR, os.path.join(Config.SCIPION_USER_DATA, 'deepfinder_cache'))
 
     @classmethod
     def getEnviron(cls):
@@ -59,13 +62,46 @@ class Plugin(pwem.Plugin):
         return cls.getVar(DF_ENV_ACTIVATION)
 
     @classmethod
-    def runDeepFinder(cls, protocol, program, args, cwd=None, useGPU=False):
-        program = cls.getDeepFinderProgram(program)
+    def getCacheDir(cls):
+        """ Folder of the files derived from the input data that can be shared between protocols (see
+        convert/cache.py). """
+        return os.path.abspath(os.path.expanduser(cls.getVar(DF_CACHE_DIR)))
+
+    @classmethod
+    def runDeepFinder(cls, protocol, program, args, cwd=None, useGPU=False, gpuId=None):
+        cls._runInDeepFinderEnv(protocol, cls.getDeepFinderProgram(program), args, cwd=cwd, useGPU=useGPU,
+                                gpuId=gpuId)
+
+    @classmethod
+    def runDeepFinderScript(cls, protocol, script, args, cwd=None, useGPU=False, gpuId=None):
+        """ Runs one of the scripts of this plugin (deepfinder/scripts) in the DeepFinder environment. The path to
+        the DeepFinder installation is passed to them with --df-home. """
+        args = '--df-home %s %s' % (cls.getHome(), args)
+        cls._runInDeepFinderEnv(protocol, getScript(script), args, cwd=cwd, useGPU=useGPU, gpuId=gpuId,
+                                isScript=True)
+
+    @classmethod
+    def _runInDeepFinderEnv(cls, protocol, program, args, cwd=None, useGPU=False, gpuId=None, isScript=False):
+        """ If gpuId is provided, the job only sees that device. Otherwise, if useGPU is True, it sees the whole GPU
+        list of the protocol. """
+        # The plugin scripts are executed by a persistent DeepFinder worker of the protocol, if it uses them, so
+        # they can keep their loaded models between jobs. The DeepFinder programs do not use the worker cache, so
+        # they are always run as separate jobs
+        workerContext = getattr(protocol, 'deepFinderWorker', None) if isScript else None
+        if workerContext:
+            with workerContext(useGPU=useGPU, gpuId=gpuId) as worker:
+                if worker:
+                    worker.run(program, args, cwd=cwd)
+                    return
 
         cmd = '%s %s && ' % (cls.getCondaActivationCmd(), cls.getDeepFinderEnvActivation())
 
-        if useGPU:
+        if gpuId is not None:
+            cmd += "CUDA_VISIBLE_DEVICES=%s " % gpuId
+        elif useGPU:
             cmd += "CUDA_VISIBLE_DEVICES=%(GPU)s "
+        if isScript:
+            cmd += 'python '
         cmd += program
         protocol.runJob(cmd, args, env=cls.getEnviron(), cwd=cwd)
 
@@ -38,7 +38,18 @@ DF_FOLDER = 'deepfinder'
 DEFAULT_ENV_NAME = getDFEnvName(DF_VERSION)
 DEFAULT_ACTIVATION_CMD = 'conda activate ' + DEFAULT_ENV_NAME
 DF_ENV_ACTIVATION = 'DF_ENV_ACTIVATION'
+DF_CACHE_DIR = 'DF_CACHE_DIR'
 # DF_CLASS_LABEL = '_dfLabel'
+DF_PROBABILITIES = '_dfProbabilities'  # TomoMask attribute with the file of the class probabilities
+
+# Shared with the scripts executed in the DeepFinder environment (see scripts/script_utils.py), so this module must not
+# import anything.
+# Steps of the uint8 class probabilities written by the segmentation
+PROBABILITIES_QUANTIZATION_LEVELS = 255
+# Weights kept by the training, ranked by validation loss
+CHECKPOINTS_MANIFEST = 'checkpoints.json'
+# Metrics of each epoch, appended by the training and read by the learning curves viewer
+TRAINING_METRICS_FILE = 'training_metrics.jsonl'
 
 # DeepFinder field for its XML coords files:
 # Mandatory attributes
@@ -1,94 +1,282 @@
+import os
+import threading
 import xml.etree.ElementTree as ET
+import numpy as np
 
 from deepfinder.constants import *
+from .object_list import ObjectList, LabelIndex, OBJL_DTYPE, OBJL_FIELDS, MISSING_INT, MISSING_FLOAT
+from .volumes import VolumeInfo, getVolumeInfo, mmapVolume, createVolume, subVolume, mmapProbabilities, \
+    decodeProbabilities, getProbabilitiesFile
+from .cache import fileHash, getCachedHashes, getCachedFiles, linkOrCopy
+from .metrics import MetricsStream, TRAINING_METRICS_FILE
+
+
+# Number of objects converted at once when streaming object lists
+OBJL_CHUNK_SIZE = 100000
+# Binary object lists are stored as NumPy .npy files containing the ObjectList structured array
+OBJL_BINARY_EXT = '.npy'
+_NPY_MAGIC = b'\x93NUMPY'
+
+
+def objl_is_binary(filename):
+    """
+    Checks if an object list is stored in the binary format. The extension is used if it is conclusive, otherwise
+    the magic bytes of the file are checked.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == OBJL_BINARY_EXT:
+        return True
+    if ext == '.xml':
+        return False
+    with open(filename, 'rb') as f:
+        return f.read(len(_NPY_MAGIC)) == _NPY_MAGIC
+
+
+def _load_objl_binary(filename, mmap_mode=None):
+    data = np.load(filename, mmap_mode=mmap_mode, allow_pickle=False)
+    if data.dtype != OBJL_DTYPE:
+        raise ValueError('%s does not contain a DeepFinder object list (unexpected dtype %s)' % (filename, data.dtype))
+    return data
+
+
+def _iter_objl_elements(filename):
+    """
+    Yields the <object> elements of a DeepFinder XML object list without keeping the whole tree in memory: each
+    element is released as soon as it has been processed.
+    """
+    context = ET.iterparse(filename, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'object':
+            yield elem
+            root.clear()
+
+
+def _objl_element_to_row(elem):
+    # Mandatory attributes:
+    lbl = int(elem.get(DF_LABEL))
+    x = float(elem.get(DF_COORD_X))
+    y = float(elem.get(DF_COORD_Y))
+    z = float(elem.get(DF_COORD_Z))
+
+    # Optional attributes:
+    tidx = elem.get(DF_TOMO_IDX)
+    objid = elem.get(DF_OBJ_ID)
+    psi = elem.get(DF_PSI)
+    phi = elem.get(DF_PHI)
+    the = elem.get(DF_THETA)
+    csize = elem.get(DF_SCORE)
+
+    # if optional attributes exist, then cast to correct type:
+    tidx = MISSING_INT if tidx is None else int(tidx)
+    objid = MISSING_INT if objid is None else int(objid)
+    csize = MISSING_INT if csize is None else int(csize)
+    if psi is not None or phi is not None or the is not None:
+        psi = float(psi)
+        phi = float(phi)
+        the = float(the)
+    else:
+        psi = phi = the = MISSING_FLOAT
+
+    # Same order as OBJL_FIELDS
+    return lbl, x, y, z, tidx, objid, psi, phi, the, csize
+
+
+def objl_iter_chunks(filename, chunk_size=OBJL_CHUNK_SIZE):
+    """
+    Reads a DeepFinder object list (XML or binary) in chunks. The XML is parsed in streaming and each chunk is
+    filled in a preallocated array, while the binary files are memory mapped, so the memory needed does not depend
+    on the size of the file.
+
+    Args:
+        filename (str): path to the object list
+        chunk_size (int): maximum number of objects per chunk
+    Returns:
+        generator of ObjectList
+    """
+    if objl_is_binary(filename):
+        data = _load_objl_binary(filename, mmap_mode='r')
+        for start in range(0, len(data), chunk_size):
+            yield ObjectList(data=np.array(data[start:start + chunk_size]))
+        return
+
+    chunk = np.empty(chunk_size, dtype=OBJL_DTYPE)
+    nRows = 0
+    for elem in _iter_objl_elements(filename):
+        chunk[nRows] = _objl_element_to_row(elem)
+        nRows += 1
+        if nRows == chunk_size:
+            yield ObjectList(data=chunk.copy())
+            nRows = 0
+    if nRows:
+        yield ObjectList(data=chunk[:nRows].copy())
+
+
+def objl_iter(filename):
+    """
+    Yields the objects of a DeepFinder object list one by one, as dicts, without loading the whole file.
+    """
+    for objl_chunk in objl_iter_chunks(filename):
+        yield from objl_chunk
 
 
 def objl_read(filename):
-    tree = ET.parse(filename)
-    objl_xml = tree.getroot()
-
-    objl = []
-    for p in range(len(objl_xml)):
-        # Mandatory attributes:
-        lbl = int(objl_xml[p].get(DF_LABEL))
-        x = float(objl_xml[p].get(DF_COORD_X))
-        y = float(objl_xml[p].get(DF_COORD_Y))
-        z = float(objl_xml[p].get(DF_COORD_Z))
-
-        # Optional attributes:
-        tidx = objl_xml[p].get(DF_TOMO_IDX)
-        objid = objl_xml[p].get(DF_OBJ_ID)
-        psi = objl_xml[p].get(DF_PSI)
-        phi = objl_xml[p].get(DF_PHI)
-        the = objl_xml[p].get(DF_THETA)
-        csize = objl_xml[p].get(DF_SCORE)
-
-        # if optional attributes exist, then cast to correct type:
-        if tidx is not None:
-            tidx = int(tidx)
-        if objid is not None:
-            objid = int(objid)
-        if csize is not None:
-            csize = int(csize)
-        if psi is not None or phi is not None or the is not None:
-            psi = float(psi)
-            phi = float(phi)
-            the = float(the)
-
-        obj = {
-            DF_TOMO_IDX: tidx,
-            DF_OBJ_ID: objid,
-            DF_LABEL: lbl,
-            DF_COORD_X: x,
-            DF_COORD_Y: y,
-            DF_COORD_Z: z,
-            DF_PSI: phi,
-            DF_PHI: psi,
-            DF_THETA: the,
-            DF_SCORE: csize
-        }
-
-        objl.append(obj)
+    """
+    Reads a DeepFinder object list file. The format (XML or binary) is detected automatically.
+
+    Args:
+        filename (str): path to the object list
+    Returns:
+        ObjectList
+    """
+    if objl_is_binary(filename):
+        return ObjectList(data=_load_objl_binary(filename))
+    objl = ObjectList()
+    for objl_chunk in objl_iter_chunks(filename):
+        objl.extend(objl_chunk)
     return objl
 
 
+# Number of objects of the object lists already counted, by (path, modification time, size)
+_objl_counts = {}
+_objl_counts_lock = threading.Lock()
+_OBJL_XML_OBJECT_TAG = b'<object'
+_OBJL_SCAN_BLOCK_SIZE = 1 << 20
+
+
+def _objl_count_binary(filename):
+    # Only the header of the .npy file is read
+    with open(filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return int(np.prod(shape))
+
+
+def _objl_count_xml(filename):
+    # Raw scan of the bytes, looking for the object tags, without parsing the XML. The end of each block is kept so
+    # the tags split between two blocks are also found
+    count = 0
+    tail = b''
+    overlap = len(_OBJL_XML_OBJECT_TAG) - 1
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(_OBJL_SCAN_BLOCK_SIZE), b''):
+            block = tail + block
+            count += block.count(_OBJL_XML_OBJECT_TAG)
+            tail = block[-overlap:]
+    return count
+
+
+def objl_count(filename):
+    """
+    Number of objects of a DeepFinder object list file, without reading the objects. The result is cached and only
+    computed again if the file is modified.
+
+    Args:
+        filename (str): path to the object list
+    Returns:
+        int
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+    with _objl_counts_lock:
+        count = _objl_counts.get(key, None)
+    if count is None:
+        count = _objl_count_binary(filename) if objl_is_binary(filename) else _objl_count_xml(filename)
+        with _objl_counts_lock:
+            # Entries of previous versions of the file are not needed anymore
+            for oldKey in [oldKey for oldKey in _objl_counts if oldKey[0] == filename]:
+                del _objl_counts[oldKey]
+            _objl_counts[key] = count
+    return count
+
+
+# Attributes of the <object> elements of the XML object lists, in the order written by DeepFinder, and their format
+_OBJL_XML_ATTRIBUTES = ((DF_TOMO_IDX, '%d'),
+                        (DF_OBJ_ID, '%d'),
+                        (DF_LABEL, '%d'),
+                        (DF_COORD_X, '%.3f'),
+                        (DF_COORD_Y, '%.3f'),
+                        (DF_COORD_Z, '%.3f'),
+                        (DF_PSI, '%.3f'),
+                        (DF_PHI, '%.3f'),
+                        (DF_THETA, '%.3f'),
+                        (DF_SCORE, '%d'))
+
+
+def _objl_xml_template(present):
+    """ Format string of an <object> element containing only the attributes flagged as present. """
+    attributes = ['%s="%s"' % (name, fmt) for (name, fmt), isPresent in zip(_OBJL_XML_ATTRIBUTES, present)
+                  if isPresent]
+    return '<object %s />' % ' '.join(attributes)
+
+
 def objl_write(objl, filename):
-    objl_xml = ET.Element('objlist')
-    for idx in range(len(objl)):
-        tidx = objl[idx][DF_TOMO_IDX]
-        objid = objl[idx][DF_OBJ_ID]
-        lbl = objl[idx][DF_LABEL]
-        x = objl[idx][DF_COORD_X]
-        y = objl[idx][DF_COORD_Y]
-        z = objl[idx][DF_COORD_Z]
-        psi = objl[idx][DF_PSI]
-        phi = objl[idx][DF_PHI]
-        the = objl[idx][DF_THETA]
-        csize = objl[idx][DF_SCORE]
-
-        obj = ET.SubElement(objl_xml, 'object')
-        if tidx is not None:
-            obj.set(DF_TOMO_IDX, str(tidx))
-        if objid is not None:
-            obj.set(DF_OBJ_ID, str(objid))
-        obj.set(DF_LABEL, str(lbl))
-        obj.set(DF_COORD_X, '%.3f' % x)
-        obj.set(DF_COORD_Y, '%.3f' % y)
-        obj.set(DF_COORD_Z, '%.3f' % z)
-        if psi is not None:
-            obj.set(DF_PSI, '%.3f' % psi)
-        if phi is not None:
-            obj.set(DF_PHI, '%.3f' % phi)
-        if the is not None:
-            obj.set(DF_THETA, '%.3f' % the)
-        if csize is not None:
-            obj.set(DF_SCORE, str(csize))
-
-    tree = ET.ElementTree(objl_xml)
-    tree.write(filename)
+    """
+    Writes a DeepFinder object list. If the file extension is OBJL_BINARY_EXT, the binary format is used. Otherwise,
+    the XML format expected by the DeepFinder programs is written.
+
+    Args:
+        objl (ObjectList or list of dict)
+        filename (str): path of the object list
+    """
+    objl = ObjectList.from_dicts(objl)
+    if os.path.splitext(filename)[1].lower() == OBJL_BINARY_EXT:
+        np.save(filename, objl.data, allow_pickle=False)
+    else:
+        objl_write_xml(objl, filename)
+
+
+def objl_write_xml(objl, filename, chunk_size=OBJL_CHUNK_SIZE):
+    """
+    Writes a DeepFinder XML object list. The <object> elements are formatted in chunks and streamed to the file,
+    instead of building the whole XML tree in memory. The output is byte to byte the same as the one generated by
+    ElementTree in DeepFinder.
+
+    Args:
+        objl (ObjectList or list of dict)
+        filename (str): path of the object list
+        chunk_size (int): number of objects formatted at once
+    """
+    objl = ObjectList.from_dicts(objl)
+    fields = [name for name, _ in _OBJL_XML_ATTRIBUTES]
+    bitWeights = 2 ** np.arange(len(fields))
+    with open(filename, 'w', encoding='us-ascii', buffering=2 ** 20) as f:
+        if not len(objl):
+            f.write('<objlist />')
+            return
+
+        f.write('<objlist>')
+        for start in range(0, len(objl), chunk_size):
+            objl_chunk = objl[start:start + chunk_size]
+            # Optional attributes may be present only in some of the objects, so the rows are grouped by the
+            # attributes they contain (encoded as a bit mask). Usually all of them share the same attributes and a
+            # single template is used for the whole chunk.
+            present = np.column_stack([objl_chunk.is_present(field) for field in fields])
+            signatures, rowSignatures = np.unique(present.dot(bitWeights), return_inverse=True)
+            if len(signatures) == 1:
+                isPresent = present[0]
+                template = _objl_xml_template(isPresent)
+                columns = [objl_chunk[field].tolist() for field, keep in zip(fields, isPresent) if keep]
+                f.write(''.join(map(template.__mod__, zip(*columns))))
+            else:
+                templates = {}
+                columns = [objl_chunk[field].tolist() for field in fields]
+                for values, rowPresent, signature in zip(zip(*columns), present.tolist(),
+                                                         rowSignatures.reshape(-1).tolist()):
+                    if signature not in templates:
+                        templates[signature] = _objl_xml_template(rowPresent)
+                    f.write(templates[signature] % tuple(value for value, keep in zip(values, rowPresent) if keep))
+        f.write('</objlist>')
 
 
 def objl_add(objl, label, coord, obj_id=None, tomo_idx=None, orient=(None, None, None), cluster_size=None):
+    if isinstance(objl, ObjectList):
+        return objl.append(label, coord, obj_id=obj_id, tomo_idx=tomo_idx, orient=orient,
+                           cluster_size=cluster_size)
     obj = {
         DF_TOMO_IDX: tomo_idx,
         DF_OBJ_ID: obj_id,
@@ -109,13 +297,14 @@ def objl_get_labels(objl):
     """
     Returns a list with different (unique) labels contained in input objl
     """
-    class_list = []
-    for idx in range(len(objl)):
-        class_list.append(objl[idx][DF_LABEL])
-    # Set only stores a value once even if it is inserted more then once:
-    lbl_set = set(class_list)  # insert the list to the set
-    lbl_list = (list(lbl_set))  # convert the set to the list
-    return lbl_list
+    return ObjectList.from_dicts(objl).get_labels()
+
+
+def objl_counts_by_label(objl):
+    """
+    Returns a dict with the number of objects of each class contained in input objl
+    """
+    return ObjectList.from_dicts(objl).counts_by_label()
 
 
 def objl_get_class(objl, label):
@@ -123,20 +312,12 @@ def objl_get_class(objl, label):
     Get all objects of specified class.
 
     Args:
-        objl (list of dict)
+        objl (ObjectList or list of dict)
         label (int)
     Returns:
-        list of dict: contains only objects from class DF_LABEL
+        ObjectList: contains only objects from class DF_LABEL
     """
-    idx_class = []
-    for idx in range(len(objl)):
-        if str(objl[idx][DF_LABEL]) == str(label):
-            idx_class.append(idx)
-
-    objlOUT = []
-    for idx in range(len(idx_class)):
-        objlOUT.append(objl[idx_class[idx]])
-    return objlOUT
+    return ObjectList.from_dicts(objl).get_class(label)
 
 
 class ParamsGenTarget:
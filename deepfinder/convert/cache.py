@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Content-addressed cache of files derived from the input volumes (e.g. their HDF5 copies for training). Each derived
+file is named after the SHA-256 of the content of its source, so it is shared by all the protocols and projects that
+use the same data, whatever the path of the source file. The digests are remembered by path, modification time and
+size, so unchanged files are hashed only once.
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+HASH_BLOCK_SIZE = 1 << 24
+_HASH_INDEX = 'hashes.json'
+_indexLock = threading.Lock()
+
+
+def _statKey(filename):
+    stat = os.stat(filename)
+    return '%s|%d|%d' % (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+
+def _readIndex(cacheDir):
+    try:
+        with open(os.path.join(cacheDir, _HASH_INDEX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _writeIndex(cacheDir, index):
+    # Written atomically, as several protocols may be using the cache at the same time
+    indexFile = os.path.join(cacheDir, _HASH_INDEX)
+    tmpFile = '%s.%d.tmp' % (indexFile, os.getpid())
+    with open(tmpFile, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmpFile, indexFile)
+
+
+def fileHash(filename):
+    """ SHA-256 of the content of a file, as an hex string. """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def getCachedHashes(cacheDir, filenames):
+    """ Content hash of each file, reusing the ones already computed for the same path, modification time and
+    size. """
+    os.makedirs(cacheDir, exist_ok=True)
+    with _indexLock:
+        index = _readIndex(cacheDir)
+        keys = [_statKey(filename) for filename in filenames]
+        missing = [(key, filename) for key, filename in zip(keys, filenames) if key not in index]
+        if missing:
+            # Forget the digests of the previous versions of the modified files
+            paths = {key.rsplit('|', 2)[0] for key, _ in missing}
+            index = {key: digest for key, digest in index.items() if key.rsplit('|', 2)[0] not in paths}
+        for key, filename in missing:
+            index[key] = fileHash(filename)
+        if missing:
+            _writeIndex(cacheDir, index)
+        return [index[key] for key in keys]
+
+
+def getCachedFiles(cacheDir, filenames, ext):
+    """ Path in the cache of the file derived from each of the given files (they may not exist yet). """
+    return [os.path.join(cacheDir, digest + ext) for digest in getCachedHashes(cacheDir, filenames)]
+
+
+def linkOrCopy(src, dst):
+    """ Make dst have the content of src: as a hard link if possible (no data copied, and it does not depend on src
+    being kept), or as a copy otherwise (e.g. different file systems). dst is replaced atomically. """
+    tmpFile = '%s.%d.%d.tmp' % (dst, os.getpid(), threading.get_ident())
+    try:
+        os.link(src, tmpFile)
+    except OSError:
+        shutil.copyfile(src, tmpFile)
+    os.replace(tmpFile, dst)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Bulk conversion of DeepFinder object lists into Scipion 3D coordinates. The positions are converted for all the
+objects at once with NumPy, so the only work left for each object is filling a single reused Coordinate3D and
+appending it to the set, which is what has to be done holding the protocol lock in parallel protocols.
+"""
+import numpy as np
+from tomo.constants import BOTTOM_LEFT_CORNER, SCIPION
+from tomo.objects import Coordinate3D
+
+
+def toScipionPositions(tomo, positions, originFunction=BOTTOM_LEFT_CORNER):
+    """ Convert an array (N, 3) of (x, y, z) positions referred to the origin given by originFunction (the bottom
+    left corner of the tomogram, as in DeepFinder, by default) to Scipion's convention. The offset is the same for
+    all the coordinates of a tomogram, so it is computed only once. """
+    coord = Coordinate3D()
+    coord.setVolume(tomo)
+    coord.setPosition(0, 0, 0, originFunction)
+    return np.asarray(positions, dtype=np.float64).reshape(-1, 3) + coord.getPosition(SCIPION)
+
+
+def groupCoordinates(coord3DSet, groupBy, originFunction=BOTTOM_LEFT_CORNER):
+    """ Read the positions and the labels (group ids) of all the coordinates of a set in a single pass, grouped by
+    the value returned by groupBy(coord), e.g. its tsId. The positions are referred to the origin given by
+    originFunction (the bottom left corner of the tomogram, as in DeepFinder, by default). All the coordinates of a
+    group must belong to the same tomogram, as the origin offset is computed only once per group.
+    Returns:
+        dict {group: (positions array (N, 3) of (x, y, z), labels array (N,))}, keeping the order of the set within
+        each group.
+    """
+    buffers = {}
+    offsets = {}
+    for coord in coord3DSet.iterCoordinates():
+        group = groupBy(coord)
+        buffer = buffers.get(group, None)
+        if buffer is None:
+            buffer = buffers[group] = ([], [])
+            offsets[group] = np.subtract(coord.getPosition(originFunction), coord.getPosition(SCIPION))
+        buffer[0].append(coord.getPosition(SCIPION))
+        buffer[1].append(coord.getGroupId())
+    return {group: (np.array(positions, dtype=np.float64).reshape(-1, 3) + offsets[group],
+                    np.array(labels, dtype=np.int64))
+            for group, (positions, labels) in buffers.items()}
+
+
+def appendCoordinates(coordSet, tomo, positions, labels, scores=None, volId=None, tomoId=None, firstObjId=None):
+    """ Append one coordinate per row of positions to coordSet.
+    Params:
+        coordSet: SetOfCoordinates3D where the coordinates are appended.
+        tomo: tomogram the coordinates belong to.
+        positions: array (N, 3) of (x, y, z) positions already in Scipion's convention (see toScipionPositions).
+        labels: class label (group id) of each coordinate.
+        scores: optional score of each coordinate (None values are allowed).
+        volId: volume id of the coordinates. The object id of tomo is used if not provided.
+        tomoId: tomo id of the coordinates. The tsId of tomo is used if not provided.
+        firstObjId: object id of the first coordinate, the next ones being consecutive. If not provided, the set
+            assigns them.
+    Returns the number of coordinates appended.
+    """
+    coord = Coordinate3D()
+    coord.setVolume(tomo)
+    if volId is not None:
+        coord.setVolId(volId)
+    if tomoId is not None:
+        coord.setTomoId(tomoId)
+    nCoords = len(positions)
+    labels = np.asarray(labels).tolist()
+    scores = [None] * nCoords if scores is None else list(scores)
+    objIds = [None] * nCoords if firstObjId is None else range(firstObjId, firstObjId + nCoords)
+    for (x, y, z), lbl, score, objId in zip(np.asarray(positions).tolist(), labels, scores, objIds):
+        coord.setObjId(objId)
+        coord.setPosition(x, y, z, SCIPION)
+        coord.setGroupId(lbl)
+        coord.setScore(score)
+        coordSet.append(coord)
+    return nCoords
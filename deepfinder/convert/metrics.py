@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+"""
+Reading of the metrics written by the training while it runs (see scripts/train.py): one JSON record per line, with
+the metrics of an epoch, appended as soon as it ends.
+"""
+import json
+import os
+
+from deepfinder.constants import TRAINING_METRICS_FILE
+
+
+class MetricsStream:
+    """ Incremental reader of an append-only JSON lines file. Each call to read returns only the records appended
+    since the previous one, so following a long training does not require reading its whole history again. A line
+    still being written is kept until it is complete. """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._offset = 0
+        self._pending = b''
+
+    def read(self):
+        """ New complete records, in the order they were written. """
+        if not os.path.exists(self._filename):
+            return []
+        with open(self._filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < self._offset:  # The file has been written again from scratch
+                self._offset, self._pending = 0, b''
+            f.seek(self._offset)
+            data = f.read()
+        self._offset += len(data)
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+        return [json.loads(line) for line in lines if line.strip()]
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import numpy as np
+
+from deepfinder.constants import *
+
+# Columns of a DeepFinder object list, in the same order used by DeepFinder when writing its XML files
+OBJL_FIELDS = (DF_LABEL, DF_COORD_X, DF_COORD_Y, DF_COORD_Z, DF_TOMO_IDX, DF_OBJ_ID, DF_PSI, DF_PHI, DF_THETA,
+               DF_SCORE)
+OBJL_DTYPE = np.dtype([(DF_LABEL, np.int32),
+                       (DF_COORD_X, np.float64),
+                       (DF_COORD_Y, np.float64),
+                       (DF_COORD_Z, np.float64),
+                       (DF_TOMO_IDX, np.int32),
+                       (DF_OBJ_ID, np.int64),
+                       (DF_PSI, np.float64),
+                       (DF_PHI, np.float64),
+                       (DF_THETA, np.float64),
+                       (DF_SCORE, np.int32)])
+# Optional attributes are stored with a sentinel value when they are not present
+OBJL_INT_OPTIONAL = (DF_TOMO_IDX, DF_OBJ_ID, DF_SCORE)
+OBJL_FLOAT_OPTIONAL = (DF_PSI, DF_PHI, DF_THETA)
+MISSING_INT = -1
+MISSING_FLOAT = np.nan
+
+
+def _isMissing(field, value):
+    if field in OBJL_INT_OPTIONAL:
+        return value == MISSING_INT
+    if field in OBJL_FLOAT_OPTIONAL:
+        return value != value  # NaN
+    return False
+
+
+class LabelIndex:
+    """ Index from each class label to the rows of an object list that belong to it. It is built once from the
+    label column (the rows are stably sorted by label), so getting the objects or the number of objects of a class
+    does not require scanning the whole list again.
+    """
+
+    def __init__(self, labels):
+        labels = np.asarray(labels)
+        self._order = np.argsort(labels, kind='stable')
+        uniqueLabels, starts, counts = np.unique(labels[self._order], return_index=True, return_counts=True)
+        self._slices = {int(lbl): (int(start), int(start + count))
+                        for lbl, start, count in zip(uniqueLabels, starts, counts)}
+
+    def labels(self):
+        """ Sorted list of the labels present in the object list. """
+        return list(self._slices)
+
+    def indices(self, label):
+        """ Row indices (in their original order) of the objects of the given class. """
+        start, end = self._slices.get(int(label), (0, 0))
+        return self._order[start:end]
+
+    def count(self, label):
+        start, end = self._slices.get(int(label), (0, 0))
+        return end - start
+
+    def counts_by_label(self):
+        """ Dict with the number of objects of each class. """
+        return {lbl: end - start for lbl, (start, end) in self._slices.items()}
+
+
+class ObjectList:
+    """ DeepFinder object list stored column-wise in a NumPy structured array (one row per object, one field per
+    DeepFinder attribute). Indexing with an integer or iterating returns the classic DeepFinder dict, so the code
+    written for the list of dicts keeps working, while indexing with a field name returns the whole column.
+    """
+
+    # Key order of the dicts generated by objl_add
+    _DICT_FIELDS = (DF_TOMO_IDX, DF_OBJ_ID, DF_LABEL, DF_COORD_X, DF_COORD_Y, DF_COORD_Z, DF_PSI, DF_PHI, DF_THETA,
+                    DF_SCORE)
+    _ITER_BLOCK_SIZE = 10000
+
+    def __init__(self, data=None, capacity=0):
+        if data is None:
+            self._buffer = self._emptyRows(capacity)
+            self._size = 0
+        else:
+            self._buffer = np.asarray(data, dtype=OBJL_DTYPE).reshape(-1)
+            self._size = len(self._buffer)
+        self._labelIndex = None
+
+    @staticmethod
+    def _emptyRows(nRows):
+        rows = np.zeros(nRows, dtype=OBJL_DTYPE)
+        for field in OBJL_INT_OPTIONAL:
+            rows[field] = MISSING_INT
+        for field in OBJL_FLOAT_OPTIONAL:
+            rows[field] = MISSING_FLOAT
+        return rows
+
+    # --------------------------- Constructors --------------------------------
+    @classmethod
+    def from_dicts(cls, objl):
+        """ Build an ObjectList from a list of DeepFinder dicts (or return it as is if it is already one). """
+        if isinstance(objl, ObjectList):
+            return objl
+        objList = cls(capacity=len(objl))
+        for obj in objl:
+            objList._appendRow(obj)
+        return objList
+
+    @classmethod
+    def from_arrays(cls, labels, x, y, z, **optional):
+        """ Build an ObjectList from column arrays. The optional attributes (tomo_idx, obj_id, psi, phi, the and
+        cluster_size) can be passed as keyword arguments. """
+        labels = np.asarray(labels)
+        objList = cls(data=cls._emptyRows(len(labels)))
+        objList._buffer[DF_LABEL] = labels
+        objList._buffer[DF_COORD_X] = x
+        objList._buffer[DF_COORD_Y] = y
+        objList._buffer[DF_COORD_Z] = z
+        for field, values in optional.items():
+            if values is not None:
+                objList._buffer[field] = values
+        return objList
+
+    @classmethod
+    def concatenate(cls, objLists):
+        """ Concatenate several object lists (ObjectList or list of dicts) into a new ObjectList. """
+        arrays = [cls.from_dicts(objl).data for objl in objLists]
+        if not arrays:
+            return cls()
+        return cls(data=np.concatenate(arrays))
+
+    # --------------------------- Access --------------------------------------
+    @property
+    def data(self):
+        """ Structured array view of the stored objects. """
+        return self._buffer[:self._size]
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        # Columns are converted in blocks, which is much faster than converting the rows one by one
+        for start in range(0, len(self), self._ITER_BLOCK_SIZE):
+            block = self[start:start + self._ITER_BLOCK_SIZE]
+            for values in zip(*[block.tolist(field) for field in self._DICT_FIELDS]):
+                yield dict(zip(self._DICT_FIELDS, values))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        if isinstance(key, (int, np.integer)):
+            return self._rowToDict(self.data[key])
+        return ObjectList(data=self.data[key])
+
+    def __repr__(self):
+        return 'ObjectList(%i objects)' % len(self)
+
+    def to_dicts(self):
+        return list(self)
+
+    def positions(self):
+        """ Array of shape (N, 3) with the coordinates of the objects, ordered as (x, y, z). """
+        data = self.data
+        return np.column_stack((data[DF_COORD_X], data[DF_COORD_Y], data[DF_COORD_Z]))
+
+    def tolist(self, field):
+        """ Values of a column as a Python list, with None for the objects that do not have that attribute. """
+        values = self.data[field].tolist()
+        if field in OBJL_INT_OPTIONAL or field in OBJL_FLOAT_OPTIONAL:
+            values = [None if _isMissing(field, value) else value for value in values]
+        return values
+
+    def is_present(self, field):
+        """ Boolean array telling which objects have the given attribute (always true for mandatory ones). """
+        values = self.data[field]
+        if field in OBJL_INT_OPTIONAL:
+            return values != MISSING_INT
+        if field in OBJL_FLOAT_OPTIONAL:
+            return ~np.isnan(values)
+        return np.ones(len(values), dtype=bool)
+
+    def has_field(self, field):
+        """ True if at least one of the objects has the given (optional) attribute. """
+        return bool(np.any(self.is_present(field)))
+
+    # --------------------------- Filtering -----------------------------------
+    def filter(self, mask):
+        """ Objects for which the given boolean mask (or index array) is true. """
+        return self[np.asarray(mask)]
+
+    def label_index(self):
+        """ LabelIndex of the object list. It is built the first time it is requested and kept until the list is
+        modified. """
+        if self._labelIndex is None:
+            self._labelIndex = LabelIndex(self.data[DF_LABEL])
+        return self._labelIndex
+
+    def get_labels(self):
+        """ Sorted list of the different labels contained in the object list. """
+        return self.label_index().labels()
+
+    def get_class(self, label):
+        """ Objects of the given class. """
+        return self[self.label_index().indices(label)]
+
+    def counts_by_label(self):
+        """ Dict with the number of objects of each class. """
+        return self.label_index().counts_by_label()
+
+    # --------------------------- Edition -------------------------------------
+    def append(self, label, coord, obj_id=None, tomo_idx=None, orient=(None, None, None), cluster_size=None):
+        """ Add an object. Same arguments than objl_add: coord is given as (z, y, x). """
+        self._appendRow({DF_TOMO_IDX: tomo_idx,
+                         DF_OBJ_ID: obj_id,
+                         DF_LABEL: label,
+                         DF_COORD_X: coord[2],
+                         DF_COORD_Y: coord[1],
+                         DF_COORD_Z: coord[0],
+                         DF_PSI: orient[0],
+                         DF_PHI: orient[1],
+                         DF_THETA: orient[2],
+                         DF_SCORE: cluster_size})
+        return self
+
+    def extend(self, objl):
+        """ Add all the objects of another object list (ObjectList or list of dicts). """
+        newRows = ObjectList.from_dicts(objl).data
+        self._reserve(self._size + len(newRows))
+        self._buffer[self._size:self._size + len(newRows)] = newRows
+        self._size += len(newRows)
+        self._labelIndex = None
+        return self
+
+    def _appendRow(self, obj):
+        self._reserve(self._size + 1)
+        row = self._buffer[self._size]
+        for field in OBJL_FIELDS:
+            value = obj.get(field, None)
+            if value is not None:
+                row[field] = value
+        self._size += 1
+        self._labelIndex = None
+
+    def _reserve(self, nRows):
+        """ Grow the underlying buffer geometrically so appending is amortized O(1). """
+        if nRows > len(self._buffer):
+            newBuffer = self._emptyRows(max(nRows, 2 * len(self._buffer), 16))
+            newBuffer[:self._size] = self._buffer[:self._size]
+            self._buffer = newBuffer
+
+    @classmethod
+    def _rowToDict(cls, row):
+        obj = {}
+        for field in cls._DICT_FIELDS:
+            value = row[field].item()
+            obj[field] = None if _isMissing(field, value) else value
+        return obj
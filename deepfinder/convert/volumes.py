@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Memory-mapped access to MRC volumes (tomograms, segmentations and targets). The header is read without touching
+the data, and the data is mapped instead of loaded, so only the parts of the volume actually used are read from disk
+and several steps can work with big tomograms at the same time. All the arrays are indexed as (z, y, x).
+"""
+from collections import namedtuple
+
+import mrcfile
+import numpy as np
+from mrcfile.utils import data_dtype_from_header, data_shape_from_header, mode_from_dtype
+
+from deepfinder.constants import DF_PROBABILITIES, PROBABILITIES_QUANTIZATION_LEVELS
+
+# Header data of a volume: dimensions as (x, y, z), voxel size (Å/voxel) as (x, y, z) and data type
+VolumeInfo = namedtuple('VolumeInfo', ['dims', 'voxelSize', 'dtype'])
+
+
+def _dataOffset(header):
+    return header.nbytes + int(header.nsymbt)
+
+
+def getVolumeInfo(filename):
+    """ Dimensions, voxel size and data type of an MRC volume, reading only its header. """
+    with mrcfile.open(filename, header_only=True, permissive=True) as mrc:
+        header = mrc.header
+        shape = data_shape_from_header(header)
+        voxelSize = mrc.voxel_size
+        return VolumeInfo(dims=tuple(int(d) for d in shape[::-1]),
+                          voxelSize=(float(voxelSize.x), float(voxelSize.y), float(voxelSize.z)),
+                          dtype=data_dtype_from_header(header))
+
+
+def mmapVolume(filename, mode='r'):
+    """ Memory-mapped array with the data of an MRC volume. It does not depend on any open file, so it can be kept
+    as long as needed. Use mode='r+' to modify the volume in place. """
+    with mrcfile.open(filename, header_only=True, permissive=True) as mrc:
+        header = mrc.header
+        shape = data_shape_from_header(header)
+        dtype = data_dtype_from_header(header)
+        offset = _dataOffset(header)
+    return np.memmap(filename, dtype=dtype, mode=mode, offset=offset, shape=shape)
+
+
+def createVolume(filename, shape, dtype=np.int8, voxelSize=None):
+    """ Create an MRC volume of the given shape (z, y, x) filled with zeros and return it memory-mapped in r+ mode,
+    so it can be written region by region without having the whole volume in memory. """
+    with mrcfile.new_mmap(filename, shape=tuple(shape), mrc_mode=mode_from_dtype(np.dtype(dtype)),
+                          fill=0, overwrite=True) as mrc:
+        if voxelSize is not None:
+            mrc.voxel_size = voxelSize
+    return mmapVolume(filename, mode='r+')
+
+
+def subVolume(volume, start, size):
+    """ View (no data is copied) of the box of the given size (z, y, x) starting at start (z, y, x). The box is
+    clipped to the volume limits. """
+    start = np.asarray(start, dtype=int)
+    end = np.minimum(start + np.asarray(size, dtype=int), volume.shape)
+    start = np.maximum(start, 0)
+    return volume[start[0]:end[0], start[1]:end[1], start[2]:end[2]]
+
+
+def getProbabilitiesFile(tomoMask):
+    """ File of the class probabilities of a segmentation (TomoMask), or None if they were not written. """
+    probabilitiesFile = getattr(tomoMask, DF_PROBABILITIES, None)
+    return probabilitiesFile.get() if probabilitiesFile is not None else None
+
+
+def mmapProbabilities(filename):
+    """ Memory-mapped class probabilities written by the segmentation, indexed as (z, y, x, class). They are stored
+    in a compact format: use decodeProbabilities to get the probabilities of the region actually needed. """
+    return np.load(filename, mmap_mode='r')
+
+
+def decodeProbabilities(values):
+    """ float32 probabilities from their compact format (float16, or uint8 quantized in
+    PROBABILITIES_QUANTIZATION_LEVELS steps). """
+    values = np.asarray(values)
+    if values.dtype == np.uint8:
+        return values.astype(np.float32) / PROBABILITIES_QUANTIZATION_LEVELS
+    return values.astype(np.float32)
@@ -0,0 +1,84 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import threading
+from contextlib import contextmanager
+
+
+class GpuScheduler:
+    """ Distributes jobs among a list of GPUs, allowing a maximum number of concurrent jobs per device. A job
+    requests a device with acquire() (or the device() context manager), which blocks until there is a free slot, and
+    gives it back to the pool with release() when it finishes. The least loaded device is always assigned first.
+    It works with any hashable device ID, so it can be tested without real GPUs.
+    """
+
+    def __init__(self, gpuIds, jobsPerGpu=1):
+        gpuIds = list(gpuIds)
+        if not gpuIds:
+            raise ValueError('At least one GPU is required.')
+        if jobsPerGpu < 1:
+            raise ValueError('The number of jobs per GPU must be at least 1.')
+        self._gpuIds = gpuIds
+        self._jobsPerGpu = jobsPerGpu
+        self._running = {gpuId: 0 for gpuId in gpuIds}
+        self._condition = threading.Condition()
+
+    def getGpuIds(self):
+        return list(self._gpuIds)
+
+    def getNumberOfSlots(self):
+        """ Maximum number of jobs that can be running at the same time. """
+        return len(self._gpuIds) * self._jobsPerGpu
+
+    def getRunningJobs(self):
+        """ Dict with the number of jobs currently running on each device. """
+        with self._condition:
+            return dict(self._running)
+
+    def acquire(self):
+        """ Wait until there is a free slot and return the ID of the device assigned. """
+        with self._condition:
+            while True:
+                # min() keeps the order of the list in case of tie
+                gpuId = min(self._gpuIds, key=lambda gpu: self._running[gpu])
+                if self._running[gpuId] < self._jobsPerGpu:
+                    self._running[gpuId] += 1
+                    return gpuId
+                self._condition.wait()
+
+    def release(self, gpuId):
+        with self._condition:
+            if self._running.get(gpuId, 0) <= 0:
+                raise ValueError('GPU %s was not acquired.' % gpuId)
+            self._running[gpuId] -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def device(self):
+        gpuId = self.acquire()
+        try:
+            yield gpuId
+        finally:
+            self.release(gpuId)
@@ -0,0 +1,143 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Clustering of DeepFinder label maps into object lists, done in-process. Two backends are available:
+    - Mean-shift: the same clustering done by DeepFinder's cluster program (scikit-learn MeanShift with bin
+      seeding over the voxels of all the classes, each cluster labelled with its most frequent class), but with the
+      neighbour searches done on a KD-tree for all the seeds at once.
+    - Connected components: each connected region of a class is an object, located at its centroid. It is much
+      faster, but touching objects of the same class are merged.
+In both cases, the coordinates are voxel indices and the cluster size is the number of voxels of the object.
+"""
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from deepfinder.convert import ObjectList
+
+MEAN_SHIFT_MAX_ITER = 300
+
+
+def _binSeeds(points, binSize):
+    """ Initial seeds of the mean-shift: the centers of the occupied bins of a grid of the given size. """
+    seeds = np.unique(np.round(points / binSize), axis=0) * binSize
+    return points if len(seeds) == len(points) else seeds
+
+
+def _ballMeans(tree, points, centers, radius, workers):
+    """ Mean of the points within radius of each center and number of them. """
+    neighbours = tree.query_ball_point(centers, radius, workers=workers, return_sorted=False)
+    counts = np.fromiter((len(nb) for nb in neighbours), dtype=np.int64, count=len(centers))
+    means = np.full(centers.shape, np.nan)
+    nonEmpty = counts > 0
+    if np.any(nonEmpty):
+        indices = np.concatenate([nb for nb in neighbours if nb]).astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(counts[nonEmpty])[:-1]))
+        means[nonEmpty] = np.add.reduceat(points[indices], offsets, axis=0) / counts[nonEmpty, None]
+    return means, counts
+
+
+def meanShift(points, bandwidth, workers=1, maxIter=MEAN_SHIFT_MAX_ITER):
+    """ Flat kernel mean-shift with bin seeding, equivalent to scikit-learn's MeanShift(bin_seeding=True). All the
+    seeds are shifted at once on each iteration.
+    Returns:
+        centers: array (nClusters, nDims) with the cluster centers, sorted by decreasing number of points.
+        assignment: index of the cluster of each point (the closest center).
+    """
+    points = np.asarray(points, dtype=np.float64)
+    tree = cKDTree(points)
+    means = _binSeeds(points, bandwidth).astype(np.float64)
+    counts = np.zeros(len(means), dtype=np.int64)
+    active = np.ones(len(means), dtype=bool)
+    stopThr = 1e-3 * bandwidth
+    for _ in range(maxIter):
+        activeInd = np.nonzero(active)[0]
+        if not len(activeInd):
+            break
+        newMeans, newCounts = _ballMeans(tree, points, means[activeInd], bandwidth, workers)
+        empty = newCounts == 0
+        # Seeds that end up with no neighbours are stopped where they are, as scikit-learn does
+        moved = ~empty
+        shift = np.linalg.norm(newMeans[moved] - means[activeInd[moved]], axis=1)
+        means[activeInd[moved]] = newMeans[moved]
+        counts[activeInd] = newCounts
+        active[activeInd[empty]] = False
+        active[activeInd[moved][shift < stopThr]] = False
+
+    # Remove the near-duplicate centers, keeping the ones with more points
+    valid = counts > 0
+    means, counts = means[valid], counts[valid]
+    order = np.lexsort(tuple(means[:, d] for d in reversed(range(means.shape[1]))) + (counts,))[::-1]
+    means = means[order]
+    unique = np.ones(len(means), dtype=bool)
+    centersTree = cKDTree(means)
+    for i in range(len(means)):
+        if unique[i]:
+            unique[centersTree.query_ball_point(means[i], bandwidth)] = False
+            unique[i] = True
+    centers = means[unique]
+
+    _, assignment = cKDTree(centers).query(points, workers=workers)
+    return centers, assignment
+
+
+def clusterMeanShift(labelmap, radius, workers=1):
+    """ Object list from a label map using mean-shift, like DeepFinder's cluster program. """
+    labelmap = np.asarray(labelmap)
+    voxels = np.argwhere(labelmap > 0)
+    if not len(voxels):
+        return ObjectList()
+    voxelLabels = labelmap[tuple(voxels.T)].astype(np.int64)
+    centers, assignment = meanShift(voxels, radius, workers=workers)
+
+    # Size and most frequent class of each cluster (the lowest label in case of tie)
+    nLabels = int(voxelLabels.max()) + 1
+    labelCounts = np.bincount(assignment * nLabels + voxelLabels,
+                              minlength=len(centers) * nLabels).reshape(len(centers), nLabels)
+    sizes = labelCounts.sum(axis=1)
+    labels = np.argmax(labelCounts[:, 1:], axis=1) + 1
+    nonEmpty = sizes > 0
+    centers, sizes, labels = centers[nonEmpty], sizes[nonEmpty], labels[nonEmpty]
+    return ObjectList.from_arrays(labels, centers[:, 2], centers[:, 1], centers[:, 0], cluster_size=sizes)
+
+
+def clusterConnectedComponents(labelmap, connectivity=1):
+    """ Object list from a label map with one object per connected region of each class, located at its
+    centroid. connectivity is the one used by scipy.ndimage (1: faces, 2: edges, 3: corners). """
+    labelmap = np.asarray(labelmap)
+    structure = ndimage.generate_binary_structure(labelmap.ndim, connectivity)
+    objLists = []
+    for label in np.unique(labelmap):
+        if label <= 0:
+            continue
+        components, nComponents = ndimage.label(labelmap == label, structure=structure)
+        voxels = np.nonzero(components)
+        componentInd = components[voxels] - 1
+        sizes = np.bincount(componentInd, minlength=nComponents)
+        centroids = [np.bincount(componentInd, weights=coords, minlength=nComponents) / sizes for coords in voxels]
+        objLists.append(ObjectList.from_arrays(np.full(nComponents, label), centroids[2], centroids[1], centroids[0],
+                                               cluster_size=sizes))
+    return ObjectList.concatenate(objLists)
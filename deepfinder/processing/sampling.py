@@ -0,0 +1,85 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import numpy as np
+
+from deepfinder.constants import *
+from deepfinder.convert import ObjectList
+
+SAMPLING_INDEX_SUFFIX = '.sampling.npz'
+
+
+def getSamplingIndexFile(objlFile):
+    """ File where the sampling index of the given object list is stored (next to it). """
+    return objlFile.rsplit('.', 1)[0] + SAMPLING_INDEX_SUFFIX
+
+
+def buildSamplingIndex(objl, tomoShapes, patchSizes, rndShift):
+    """ Precompute everything needed to sample training patches around the objects of an object list, so the trainer
+    draws each patch in constant time. DeepFinder shifts each object position by a random amount in
+    [-rndShift, rndShift] and then moves it inside the tomogram so the patch does not cross the borders: for each patch
+    size, the range of patch centers that can be reached from each object is stored, so a patch center is drawn by
+    clipping the shifted position to it.
+    Params:
+        objl: ObjectList (or list of DeepFinder dicts) with the tomo_idx of each object.
+        tomoShapes: dimensions, as (z, y, x), of each tomogram, indexed by tomo_idx.
+        patchSizes: patch sizes (voxels) the index is built for.
+        rndShift: maximum random shift (voxels) applied to the object positions.
+    Returns a dict of arrays, ready to be stored with np.savez:
+        tomo_idx, label, position: tomogram, class and position, as (z, y, x), of each object.
+        rnd_shift: maximum random shift.
+        class_labels, class_starts, class_order: objects of each class, class_labels[i] objects being
+            class_order[class_starts[i]:class_starts[i + 1]].
+        low_<psize>, high_<psize>: lowest and highest patch centers, as (z, y, x), of each object.
+    """
+    objl = ObjectList.from_dicts(objl)
+    tomoIdx = objl[DF_TOMO_IDX].astype(np.int32)
+    labels = objl[DF_LABEL].astype(np.int32)
+    shapes = np.asarray(tomoShapes, dtype=np.int64).reshape(-1, 3)[tomoIdx]
+    # DeepFinder truncates the coordinates to int
+    positions = np.trunc(np.column_stack((objl[DF_COORD_Z], objl[DF_COORD_Y], objl[DF_COORD_X]))).astype(np.int64)
+
+    labelIndex = objl.label_index()
+    classLabels = np.array(labelIndex.labels(), dtype=np.int32)
+    classCounts = np.array([labelIndex.count(lbl) for lbl in classLabels], dtype=np.int64)
+    index = {'tomo_idx': tomoIdx,
+             'label': labels,
+             'position': positions.astype(np.int32),
+             'rnd_shift': np.int32(rndShift),
+             'class_labels': classLabels,
+             'class_starts': np.concatenate(([0], np.cumsum(classCounts))).astype(np.int64),
+             'class_order': np.concatenate([labelIndex.indices(lbl) for lbl in classLabels] or
+                                           [np.empty(0, dtype=np.int64)]).astype(np.int64),
+             'patch_sizes': np.array(patchSizes, dtype=np.int32)}
+
+    for psize in patchSizes:
+        half = psize // 2
+        index['low_%d' % psize] = np.clip(positions - rndShift, half, shapes - half).astype(np.int32)
+        index['high_%d' % psize] = np.clip(positions + rndShift, half, shapes - half).astype(np.int32)
+    return index
+
+
+def writeSamplingIndex(objl, tomoShapes, patchSizes, rndShift, filename):
+    np.savez(filename, **buildSamplingIndex(objl, tomoShapes, patchSizes, rndShift))
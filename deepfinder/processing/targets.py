@@ -0,0 +1,96 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import numpy as np
+
+from deepfinder.constants import *
+from deepfinder.convert import ObjectList
+
+
+def createSphere(dim, radius):
+    """ Binary sphere of the given radius inside a cube of side dim, centered at floor(dim / 2). It is the same shape
+    painted by DeepFinder's create_sphere. """
+    center = dim // 2
+    coords = (np.arange(dim) - center) / radius
+    dist = coords[:, None, None] ** 2 + coords[None, :, None] ** 2 + coords[None, None, :] ** 2
+    return np.int8(dist <= 1)
+
+
+def _getSphereKernels(radiusList):
+    """ For each class, the sphere cropped to its bounding box and the offset of the box from the object position.
+    All the spheres are built in a cube of side 2 * max(radius), as DeepFinder does, so the painted voxels are the
+    same ones. """
+    dim = 2 * max(radiusList)
+    center = dim // 2
+    kernels = []
+    for radius in radiusList:
+        sphere = createSphere(dim, radius).astype(bool)
+        nonzero = np.nonzero(sphere)
+        start = np.array([ind.min() for ind in nonzero])
+        end = np.array([ind.max() + 1 for ind in nonzero])
+        kernel = sphere[start[0]:end[0], start[1]:end[1], start[2]:end[2]]
+        kernels.append((kernel, start - center))
+    return kernels
+
+
+def generateSphereTargets(objl, tomoShape, radiusList, target=None):
+    """ Paint a sphere of the radius of its class at the position of each object, like DeepFinder's generate_target
+    with the 'spheres' strategy.
+    Params:
+        objl: ObjectList (or list of DeepFinder dicts). Labels go from 1 to len(radiusList).
+        tomoShape: tomogram dimensions, as (z, y, x).
+        radiusList: sphere radius, in voxels, of each class.
+        target: optional initial target (int8 array of shape tomoShape, e.g. a memory-mapped volume) where the
+            spheres are painted.
+    Returns the target, as an int8 array of shape tomoShape. Overlapping spheres are overwritten by the objects
+    coming later in the list.
+    """
+    objl = ObjectList.from_dicts(objl)
+    tomoShape = np.array(tomoShape)
+    if target is None:
+        target = np.zeros(tomoShape, dtype=np.int8)
+    kernels = _getSphereKernels(radiusList)
+
+    labels = objl[DF_LABEL]
+    if len(labels) and (labels.min() < 1 or labels.max() > len(radiusList)):
+        raise ValueError('Object labels must be between 1 and the number of radii (%i).' % len(radiusList))
+    # DeepFinder truncates the coordinates to int
+    positions = np.trunc(np.column_stack((objl[DF_COORD_Z], objl[DF_COORD_Y], objl[DF_COORD_X]))).astype(int)
+
+    for label, pos in zip(labels.tolist(), positions):
+        kernel, offset = kernels[label - 1]
+        start = pos + offset
+        end = start + kernel.shape
+        # Clip the box to the tomogram and the kernel accordingly
+        tStart = np.maximum(start, 0)
+        tEnd = np.minimum(end, tomoShape)
+        if np.any(tEnd <= tStart):
+            continue
+        kStart = tStart - start
+        kEnd = kStart + (tEnd - tStart)
+        targetBox = target[tStart[0]:tEnd[0], tStart[1]:tEnd[1], tStart[2]:tEnd[2]]
+        targetBox[kernel[kStart[0]:kEnd[0], kStart[1]:kEnd[1], kStart[2]:kEnd[2]]] = label
+    return target
+
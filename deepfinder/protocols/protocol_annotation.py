@@ -30,10 +30,10 @@ from pyworkflow.gui import askYesNo
 from pyworkflow.object import String, Integer
 from pyworkflow.protocol import IntParam
 from pyworkflow.utils import removeBaseExt, Message
-from tomo.constants import BOTTOM_LEFT_CORNER
 from tomo.protocols import ProtTomoPicking
-from tomo.objects import Coordinate3D, SetOfCoordinates3D
+from tomo.objects import SetOfCoordinates3D
 import deepfinder.convert as cv
+from deepfinder.convert.coordinates import toScipionPositions, appendCoordinates
 from deepfinder.constants import *
 from deepfinder.viewers.particle_annotator_tomo_viewer import ParticleAnnotatorDialog
 from deepfinder.viewers.particle_annotator_tree import ParticleAnnotatorProvider
@@ -99,35 +99,27 @@ class DeepFinderAnnotations(ProtTomoPicking):
             tomoName = tomo.getFileName()
             # Read objl:
             fname_objl = 'objl_annot_' + removeBaseExt(tomoName) + '.xml'
-            objl_tomo = cv.objl_read(abspath(self._getExtraPath(fname_objl)))
+            nObjects = 0
+            classCounts = {}
+            for objl_tomo in cv.objl_iter_chunks(abspath(self._getExtraPath(fname_objl))):
+                nObjects += len(objl_tomo)
+                for lbl, nLblObjects in objl_tomo.counts_by_label().items():
+                    classCounts[lbl] = classCounts.get(lbl, 0) + nLblObjects
+
+                coordCounter += appendCoordinates(coord3DSet, tomo,
+                                                  toScipionPositions(tomo, objl_tomo.positions()),
+                                                  objl_tomo[DF_LABEL],
+                                                  firstObjId=coordCounter + 1)
 
             # Generate string for protocol summary:
             msg = 'Tomogram ' + tomoName + ': a total of ' + \
-                  str(len(objl_tomo)) + ' objects has been annotated.'
+                  str(nObjects) + ' objects has been annotated.'
             annotationSummary += msg
-            lbl_list = cv.objl_get_labels(objl_tomo)
-            for lbl in lbl_list:
-                objl_class = cv.objl_get_class(objl_tomo, lbl)
-                msg = '\nClass ' + str(lbl) + ': ' + str(len(objl_class)) + ' objects'
+            for lbl in sorted(classCounts):
+                msg = '\nClass ' + str(lbl) + ': ' + str(classCounts[lbl]) + ' objects'
                 annotationSummary += msg
             annotationSummary += '\n'
 
-            for idx in range(len(objl_tomo)):
-                x = objl_tomo[idx][DF_COORD_X]
-                y = objl_tomo[idx][DF_COORD_Y]
-                z = objl_tomo[idx][DF_COORD_Z]
-                lbl = objl_tomo[idx][DF_LABEL]
-
-                coord = Coordinate3D()
-                coord.setObjId(coordCounter + 1)
-                coord.setVolume(tomo)
-                coord.setPosition(x, y, z, BOTTOM_LEFT_CORNER)
-                coord.setVolId(tomo.getObjId())
-                coord.setGroupId(lbl)
-
-                coord3DSet.append(coord)
-                coordCounter += 1
-
         self._defineOutputs(**{self._possibleOutputs.coordinates.name: coord3DSet})
         self._defineSourceRelation(setTomograms, coord3DSet)
 
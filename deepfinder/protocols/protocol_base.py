@@ -24,12 +24,23 @@
 # *  e-mail address 'you@yourinstitution.email'
 # *
 # **************************************************************************
+import logging
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
 from deepfinder import DF_LABEL
+from deepfinder.gpu_scheduler import GpuScheduler
+from deepfinder.worker import DeepFinderWorker
 from pyworkflow.object import Integer
-from tomo.constants import BOTTOM_LEFT_CORNER
+from pyworkflow.protocol import params, LEVEL_ADVANCED
+from pyworkflow.utils import cyanStr
 from tomo.objects import SetOfTomograms, Coordinate3D
 from tomo.protocols import ProtTomoBase
 import deepfinder.convert as cv
+from deepfinder.convert.coordinates import groupCoordinates
+
+logger = logging.getLogger(__name__)
 
 
 class ProtDeepFinderBase(ProtTomoBase):
@@ -38,6 +49,135 @@ class ProtDeepFinderBase(ProtTomoBase):
     OBJL = 'objl'
     PARAMS_XML = 'paramsXml'
 
+    _workerLock = threading.Lock()
+
+    # --------------------------- DeepFinder worker ---------------------------
+    @staticmethod
+    def _defineWorkerParams(form):
+        form.addParam('useWorker', params.BooleanParam,
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Use persistent DeepFinder processes?',
+                      help='If yes, the scripts of this plugin that run in the DeepFinder environment (e.g. the '
+                           'segmentation) are executed by processes that are kept alive between steps, so the '
+                           'environment activation, the TensorFlow loading and the loading of the network weights are '
+                           'done only once per process, which saves a lot of time when there are many small '
+                           'tomograms. Each process runs one job at a time, and a new one is started when all the '
+                           'processes of a device are busy. The DeepFinder programs (e.g. target generation) are '
+                           'always run as separate jobs. The processes are stopped when the protocol finishes.')
+
+    @contextmanager
+    def deepFinderWorker(self, useGPU=False, gpuId=None):
+        """ Persistent DeepFinder worker of the protocol for the given device, reserved for the caller until the
+        context ends. An idle worker of the device is reused if there is one (so the objects cached by the previous
+        jobs are found), otherwise a new one is started, so the parallel steps are not serialized. None is yielded if
+        the protocol is not configured to use them. """
+        useWorker = getattr(self, 'useWorker', None)
+        if not useWorker or not useWorker.get():
+            yield None
+            return
+        if gpuId is not None:
+            cudaDevices = str(gpuId)
+        elif useGPU:
+            cudaDevices = ','.join(str(gpu) for gpu in self.getGpuList())
+        else:
+            cudaDevices = None
+        with self._workerLock:
+            workers = self.__dict__.setdefault('_dfWorkers', {}).setdefault(cudaDevices, [])
+            idleWorkers = self.__dict__.setdefault('_dfIdleWorkers', {}).setdefault(cudaDevices, [])
+            worker = None
+            while idleWorkers and worker is None:
+                worker = idleWorkers.pop()
+                if not worker.isRunning():
+                    workers.remove(worker)
+                    worker = None
+            if worker is None:
+                # Each worker has its own address file, so their names never repeat
+                nStarted = self.__dict__.get('_dfWorkersStarted', 0) + 1
+                self._dfWorkersStarted = nStarted
+                name = 'cpu' if cudaDevices is None else 'gpu' + cudaDevices.replace(',', '_')
+                worker = DeepFinderWorker(self._getTmpPath(), cudaDevices=cudaDevices,
+                                          name='%s_%d' % (name, nStarted))
+                workers.append(worker)
+        try:
+            if not worker.isRunning():
+                worker.start()  # Out of the lock, as loading TensorFlow takes a while
+            yield worker
+        finally:
+            with self._workerLock:
+                idleWorkers.append(worker)
+
+    def stopWorkerStep(self):
+        with self._workerLock:
+            workers = self.__dict__.get('_dfWorkers', {})
+            for deviceWorkers in workers.values():
+                for worker in deviceWorkers:
+                    worker.stop()
+            workers.clear()
+            self.__dict__.get('_dfIdleWorkers', {}).clear()
+
+    # --------------------------- Streaming ----------------------------------
+    STREAMING_MIN_SLEEP = 10  # seconds between two checks of a streaming input set
+
+    def _iterNewInputItems(self, inputSet):
+        """ Follow a streaming input set until it is closed, yielding the items that appear in it as dicts of
+        {tsId: clone of the item}. Each item is yielded only once: only the items with a higher id than the last one
+        seen are read from the set. It is meant for the stepsGeneratorStep of the streaming protocols
+        (ProtStreamingBase), which insert the steps of the new items. """
+        lastId = 0
+        while True:
+            with self._lock:
+                # The stream state is checked first, so no item added before the set was closed is missed
+                streamOpen = inputSet.isStreamOpen()
+                newItems = {}
+                for item in inputSet.iterItems(where='id > %d' % lastId):
+                    lastId = max(lastId, item.getObjId())
+                    newItems[item.getTsId()] = item.clone()
+            if newItems:
+                yield newItems
+            if not streamOpen:
+                logger.info(cyanStr('Input set closed.'))
+                return
+            # The set is not polled more often than every STREAMING_MIN_SLEEP seconds, even if the protocol is
+            # configured not to wait, as each check locks the protocol and reads the set database
+            sleepOnWait = max(self._getStreamingSleepOnWait(), self.STREAMING_MIN_SLEEP)
+            logger.info('Waiting %d s before checking again for new input' % sleepOnWait)
+            time.sleep(sleepOnWait)
+            with self._lock:
+                inputSet.loadAllProperties()  # Refresh the stream state
+
+    # --------------------------- GPU scheduling ------------------------------
+    @staticmethod
+    def _defineGpuSchedulingParams(form):
+        form.addParam('jobsPerGpu', params.IntParam,
+                      default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      validators=[params.GE(1)],
+                      label='Concurrent jobs per GPU',
+                      help='Each DeepFinder job is assigned one of the GPUs of the GPU list, and the device is '
+                           'given back to the pool when the job finishes. This is the maximum number of jobs that can '
+                           'be running on the same GPU at once. To use all the GPUs, the number of threads should be '
+                           'at least (number of GPUs) x (jobs per GPU) + 1.')
+
+    def getGpuScheduler(self):
+        """ GpuScheduler shared by all the steps of the protocol. """
+        with self._workerLock:
+            scheduler = self.__dict__.get('_gpuScheduler', None)
+            if scheduler is None:
+                scheduler = GpuScheduler(self.getGpuList(), self.jobsPerGpu.get())
+                self._gpuScheduler = scheduler
+        return scheduler
+
+    @staticmethod
+    def _genObjl(coords, tomoInd, labelCorrection=0):
+        """ ObjectList of a tomogram from its positions (referred to the bottom left corner, as DeepFinder expects)
+        and labels, as returned by groupCoordinates. coords is None for tomograms without coordinates. """
+        if coords is None:
+            return cv.ObjectList()
+        positions, labels = coords
+        return cv.ObjectList.from_arrays(labels + labelCorrection, positions[:, 0], positions[:, 1], positions[:, 2],
+                                         tomo_idx=np.full(len(labels), tomoInd))
+
     @staticmethod
     def _getObjlFromInputCoordinates(coord3DSet):
         """Get all objects of specified class.
@@ -45,7 +185,8 @@ class ProtDeepFinderBase(ProtTomoBase):
             tomoSet (SetOfTomograms)
             coord3DSet (SetOfCoordinates3D)
         Returns:
-            list of dict: deep finder object list (contains particle infos)
+            list of dict: one dict per tomogram with the tomogram, its deep finder object list (ObjectList) and
+            the name of its target generation params file
         """
         # Coordinate _groupId attribute is used to store the DeepFinder class label, that has to be greater than zero.
         # To avoid the zero value of _groupId of non-DeepFinder annotated coordinates, they must be corrected if
@@ -53,17 +194,13 @@ class ProtDeepFinderBase(ProtTomoBase):
         groupIds = coord3DSet.getUniqueValues(Coordinate3D.GROUP_ID_ATTR)
         dfLabelCorrection = 1 if min(groupIds) == 0 else 0
 
+        # All the coordinates are read in a single query, grouped by tomogram
+        coordsByTomo = groupCoordinates(coord3DSet, lambda coord: coord.getTomoId())
         objlListDict = []
-        tomoList = [tomo.clone() for tomo in coord3DSet.getPrecedents()]
-        for tomoInd, tomo in enumerate(tomoList):
-            objl = []
-            for coord in coord3DSet.iterCoordinates(volume=tomo):
-                x = coord.getX(BOTTOM_LEFT_CORNER)
-                y = coord.getY(BOTTOM_LEFT_CORNER)
-                z = coord.getZ(BOTTOM_LEFT_CORNER)
-                lbl = coord.getGroupId() + dfLabelCorrection
-                cv.objl_add(objl, label=lbl, coord=[z, y, x], tomo_idx=tomoInd)
-            objlListDict.append({ProtDeepFinderBase.TOMO: tomo.clone(),
+        for tomoInd, tomo in enumerate(coord3DSet.getPrecedents()):
+            tomo = tomo.clone()
+            objl = ProtDeepFinderBase._genObjl(coordsByTomo.get(tomo.getTsId(), None), tomoInd, dfLabelCorrection)
+            objlListDict.append({ProtDeepFinderBase.TOMO: tomo,
                                  ProtDeepFinderBase.OBJL: objl,
                                  ProtDeepFinderBase.PARAMS_XML: f'params_target_generation_{tomoInd + 1}.xml'
                                  })
@@ -80,19 +217,15 @@ class ProtDeepFinderBase(ProtTomoBase):
             coord3DSet (SetOfCoordinates3D)
             nValTomoMasks (int): number of validation tomo masks
         Returns:
-            list of dict: deep finder object list (contains particle infos)
+            ObjectList, ObjectList: deep finder object lists for training and validation
         """
-        objl_train = []
-        objl_valid = []
+        coordsByVolId = groupCoordinates(coord3DSet, lambda coord: coord.getVolId())
+        validObjls, trainObjls = [], []
         for tidx, tomoMask in enumerate(tomoMasksList):
-            tomoId = tomoMask.getObjId()
-            listToAdd = objl_valid if tidx <= nValTomoMasks - 1 else objl_train
-            for coord in coord3DSet.iterCoordinates(volume=tomoId):
-                x = coord.getX(BOTTOM_LEFT_CORNER)
-                y = coord.getY(BOTTOM_LEFT_CORNER)
-                z = coord.getZ(BOTTOM_LEFT_CORNER)
-                lbl = coord.getGroupId()
-                cv.objl_add(listToAdd, label=lbl, coord=[z, y, x], tomo_idx=tidx)
+            objls = validObjls if tidx <= nValTomoMasks - 1 else trainObjls
+            objls.append(ProtDeepFinderBase._genObjl(coordsByVolId.get(tomoMask.getObjId(), None), tidx))
+        objl_train = cv.ObjectList.concatenate(trainObjls)
+        objl_valid = cv.ObjectList.concatenate(validObjls)
         return objl_train, objl_valid
 
 
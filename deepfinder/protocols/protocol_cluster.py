@@ -26,16 +26,18 @@
 # **************************************************************************
 from enum import Enum
 from pyworkflow.object import String
-from pyworkflow.protocol import params, PointerParam, STEPS_PARALLEL
+from pyworkflow.protocol import params, PointerParam, STEPS_PARALLEL, ProtStreamingBase
 from pyworkflow.utils import removeBaseExt, cyanStr
 from pyworkflow.utils.properties import Message
-from tomo.constants import BOTTOM_LEFT_CORNER
-from tomo.objects import Coordinate3D, SetOfTomograms, SetOfCoordinates3D
+from tomo.objects import SetOfTomograms, SetOfCoordinates3D
 from tomo.protocols import ProtTomoPicking
 from deepfinder import Plugin
 from deepfinder.constants import *
 import deepfinder.convert as cv
+from deepfinder.convert.coordinates import toScipionPositions, appendCoordinates
+from deepfinder.processing import clusterMeanShift, clusterConnectedComponents
 from deepfinder.protocols import ProtDeepFinderBase
+from deepfinder.scripts.script_utils import readProgress, appendProgress
 import os
 from tomo.utils import getObjFromRelation
 import logging
@@ -46,13 +48,18 @@ class DFClusterOutputs(Enum):
     coordinates = SetOfCoordinates3D
 
 
-class DeepFinderCluster(ProtTomoPicking, ProtDeepFinderBase):
-    """This protocol analyses segmentation maps and outputs particle coordinates and class."""
+class DeepFinderCluster(ProtTomoPicking, ProtDeepFinderBase, ProtStreamingBase):
+    """This protocol analyses segmentation maps and outputs particle coordinates and class. The input set can be
+    still growing (streaming): the new segmentations are analysed as they appear."""
 
     _label = 'cluster'
     _possibleOutputs = DFClusterOutputs
     stepsExecutionMode = STEPS_PARALLEL
 
+    MEAN_SHIFT = 0
+    CONNECTED_COMPONENTS = 1
+    DF_PROGRAM = 2
+
     def __init__(self, **args):
         super().__init__(**args)
         self.clusteringSummary = String()
@@ -72,35 +79,59 @@ class DeepFinderCluster(ProtTomoPicking, ProtDeepFinderBase):
                       label='Clustering radius',
                       important=True,
                       help='Should correspond to average radius of target objects (in voxels)')
+        form.addParam('clusterMethod', params.EnumParam,
+                      choices=['Mean-shift', 'Connected components', 'DeepFinder program'],
+                      default=self.MEAN_SHIFT,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      label='Clustering method',
+                      help='*Mean-shift*: the clustering done by DeepFinder, computed in Scipion using the number '
+                           'of threads of the protocol.\n'
+                           '*Connected components*: each connected region of a class is considered an object, '
+                           'located at its center. It is much faster, but touching objects of the same class are '
+                           'merged into one.\n'
+                           '*DeepFinder program*: mean-shift executed by the DeepFinder cluster program.')
         form.addParallelSection(threads=4, mpi=1)
+        self._defineStreamingParams(form)
 
-    # --------------------------- INSERT steps functions ----------------------
-    def _insertAllSteps(self):
-        self.__initialize()
+    # --------------------------- STEPS functions -----------------------------
+    def stepsGeneratorStep(self):
+        """ Insert the clustering steps of the input segmentations as they appear in the input set, until it is
+        closed. The segmentations already registered (e.g. when the protocol is continued) are skipped. """
+        inTomoMasks = self.inputSegmentations.get()
+        processed = set(readProgress(self._getProgressFile()))
+        self.tomoMasksDict = {}
         closeDeps = []
-        ind = 0
-        for tsId in self.tomoMasksDict.keys():
-            pid = self._insertFunctionStep(self.launchClusteringStep, tsId,
-                                           prerequisites=[],
-                                           needsGPU=False)
-            cOutId = self._insertFunctionStep(self.createOutputStep, tsId, ind,
-                                           prerequisites=pid,
-                                           needsGPU=False)
-            closeDeps.append(cOutId)
-            ind += 1
+        for newTomoMasks in self._iterNewInputItems(inTomoMasks):
+            self.tomoMasksDict.update(newTomoMasks)
+            for tsId, tomoMask in newTomoMasks.items():
+                if tsId in processed:
+                    continue
+                pid = self._insertFunctionStep(self.launchClusteringStep, tsId,
+                                               prerequisites=[],
+                                               needsGPU=False)
+                # The id of the segmentation in the input set identifies its coordinates, even between executions
+                cOutId = self._insertFunctionStep(self.createOutputStep, tsId, tomoMask.getObjId(),
+                                                  prerequisites=pid,
+                                                  needsGPU=False)
+                closeDeps.append(cOutId)
+
         self._insertFunctionStep(self._closeOutputSet,
                                  prerequisites=closeDeps,
                                  needsGPU=False)
 
-    # --------------------------- STEPS functions -----------------------------
-    def __initialize(self):
-        self.tomoMasksDict = {tomoMask.getTsId(): tomoMask.clone() for tomoMask in self.inputSegmentations.get()}
-
     def launchClusteringStep(self, tsId: str):
         logger.info(cyanStr(f'Clustering step of ---> {tsId}'))
         segm = self.tomoMasksDict[tsId]
-        fname_objl = 'objl_' + removeBaseExt(segm.getFileName()) + '.xml'
-        fname_objl = os.path.abspath(os.path.join(self._getExtraPath(), fname_objl))
+        fname_objl = self._getObjlFileName(segm)
+        clusterMethod = self.clusterMethod.get()
+        if clusterMethod != self.DF_PROGRAM:
+            labelmap = cv.mmapVolume(segm.getFileName())
+            if clusterMethod == self.MEAN_SHIFT:
+                objl = clusterMeanShift(labelmap, self.cradius.get(), workers=self._getClusteringWorkers())
+            else:
+                objl = clusterConnectedComponents(labelmap)
+            cv.objl_write(objl, fname_objl)
+            return
 
         # Launch DeepFinder executable:
         deepfinder_args = '-l ' + segm.getFileName()
@@ -109,55 +140,42 @@ class DeepFinderCluster(ProtTomoPicking, ProtDeepFinderBase):
 
         Plugin.runDeepFinder(self, 'cluster', deepfinder_args)
 
-    def createOutputStep(self, tsId: str, segmInd: int):
+    def _getClusteringWorkers(self):
+        """ Threads used by each clustering step. One thread runs the steps generator, and the rest are shared by the
+        clustering steps that may be running at the same time (at most one per segmentation). """
+        stepThreads = max(self.numberOfThreads.get() - 1, 1)
+        return max(stepThreads // min(stepThreads, max(len(self.tomoMasksDict), 1)), 1)
+
+    def createOutputStep(self, tsId: str, segmId: int):
+        segm = self.tomoMasksDict[tsId]
+        logger.info(cyanStr(f'Generating the output of ---> {tsId}'))
+        # Get tomo corresponding to current tomomask:
+        tomo = segm.getTomogram()
+        tomoId = segm.getTsId()
+
+        # Everything that does not touch the output set is prepared before taking the lock
+        objl_tomo = cv.objl_read(self._getObjlFileName(segm))
+        positions = toScipionPositions(tomo, objl_tomo.positions())
+        scores = objl_tomo.tolist(DF_SCORE)
+        classCounts = objl_tomo.counts_by_label()
+
+        # Generate string for protocol summary:
+        clusteringSummary = 'Segmentation ' + str(segmId) + ': a total of ' + str(len(objl_tomo)) + \
+                            ' objects has been found.'
+        for lbl in sorted(classCounts):
+            clusteringSummary += '\nClass ' + str(lbl) + ': ' + str(classCounts[lbl]) + ' objects'
+        clusteringSummary += '\n'
+
         with self._lock:
-            segm = self.tomoMasksDict[tsId]
-            logger.info(cyanStr(f'Generating the output of ---> {tsId}'))
             # Convert DeepFinder annotation output to Scipion SetOfCoordinates3D
             outCoords = self.createOutputSet()
-            clusteringSummary = ''
-            # Get objl filename:
-            fname_segm = os.path.splitext(segm.getFileName())
-            fname_segm = os.path.basename(fname_segm[0])
-            fname_objl = 'objl_' + fname_segm + '.xml'
-
-            # Read objl:
-            objl_tomo = cv.objl_read(os.path.abspath(os.path.join(self._getExtraPath(), fname_objl)))
-
-            # Generate string for protocol summary:
-            msg = 'Segmentation ' + str(segmInd + 1) + ': a total of ' + str(
-                len(objl_tomo)) + ' objects has been found.'
-            clusteringSummary += msg
-            lbl_list = cv.objl_get_labels(objl_tomo)
-            for lbl in lbl_list:
-                objl_class = cv.objl_get_class(objl_tomo, lbl)
-                msg = '\nClass ' + str(lbl) + ': ' + str(len(objl_class)) + ' objects'
-                clusteringSummary += msg
-            clusteringSummary += '\n'
-
-            # Get tomo corresponding to current tomomask:
-            tomo = segm.getTomogram()
-            tomoId = segm.getTsId()
-
-            for idx in range(len(objl_tomo)):
-                x = objl_tomo[idx][DF_COORD_X]
-                y = objl_tomo[idx][DF_COORD_Y]
-                z = objl_tomo[idx][DF_COORD_Z]
-                lbl = objl_tomo[idx][DF_LABEL]
-                score = objl_tomo[idx][DF_SCORE]
-
-                coord = Coordinate3D()
-                coord.setVolume(tomo)
-                coord.setPosition(x, y, z, BOTTOM_LEFT_CORNER)
-                coord.setTomoId(tomoId)
-                coord.setVolId(segmInd + 1)
-                coord.setGroupId(lbl)
-                coord.setScore(score)
-
-                outCoords.append(coord)
+            appendCoordinates(outCoords, tomo, positions, objl_tomo[DF_LABEL], scores=scores,
+                              volId=segmId, tomoId=tomoId)
 
             self.clusteringSummary.set(clusteringSummary)
             self._store(self.clusteringSummary)
+            # Segmentations without objects do not appear in the output, so the processed ones are recorded apart
+            appendProgress(self._getProgressFile(), tsId)
 
     # --------------------------- DEFINE info functions ---------------------- # TODO
     def _summary(self):
@@ -172,7 +190,20 @@ class DeepFinderCluster(ProtTomoPicking, ProtDeepFinderBase):
 
         return summary
 
+    def _validate(self):
+        errorMsg = []
+        self._validateThreads(errorMsg)
+        return errorMsg
+
     # --------------------------- UTILS functions -----------------------------
+    def _getProgressFile(self):
+        return self._getExtraPath('clustering_done.txt')
+
+    def _getObjlFileName(self, segm):
+        # The object lists generated in Scipion are stored in binary format
+        ext = '.xml' if self.clusterMethod.get() == self.DF_PROGRAM else cv.OBJL_BINARY_EXT
+        return os.path.abspath(self._getExtraPath('objl_' + removeBaseExt(segm.getFileName()) + ext))
+
     def createOutputSet(self) -> SetOfCoordinates3D:
         outCoords = getattr(self, self._possibleOutputs.coordinates.name, None)
         boxSize = 2 * self.cradius.get()
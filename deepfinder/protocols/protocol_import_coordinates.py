@@ -25,17 +25,36 @@
 # *
 # **************************************************************************
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from os.path import basename
 
 from deepfinder.constants import *
 from pyworkflow.protocol import LEVEL_ADVANCED
 from pyworkflow.utils import removeBaseExt
-from tomo.constants import BOTTOM_LEFT_CORNER
-from tomo.objects import SetOfCoordinates3D, Coordinate3D
+from tomo.objects import SetOfCoordinates3D
 from tomo.protocols.protocol_base import ProtTomoImportFiles
 import pyworkflow.protocol.params as params
 import deepfinder.convert as cv
+from deepfinder.convert.coordinates import toScipionPositions, appendCoordinates
+
+
+def _readObjlData(coordFile):
+    # Executed in the worker processes: the structured array is much cheaper to send back than the ObjectList
+    return cv.objl_read(coordFile).data
+
+
+def _mapInOrder(executor, func, items, maxPending):
+    """ Like executor.map, but keeping at most maxPending tasks submitted and not consumed yet (executor.map submits
+    them all at once, so every result would be kept in memory until it is consumed). """
+    pending = deque()
+    for item in items:
+        if len(pending) >= maxPending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
 
 
 class DFImportCoordsOutputs(Enum):
@@ -63,6 +82,8 @@ class ImportCoordinates3D(ProtTomoImportFiles):
                       default=50,
                       help='Default box size for the output.')
 
+        form.addParallelSection(threads=4, mpi=0)
+
     def _insertAllSteps(self):
         self._insertFunctionStep(self.importCoordinatesStep)
 
@@ -74,34 +95,36 @@ class ImportCoordinates3D(ProtTomoImportFiles):
         coord3DSet.setPrecedents(importTomograms)
         coord3DSet.setBoxSize(boxSize)
         coord3DSet.setSamplingRate(importTomograms.getSamplingRate())
-        coordCounter = 1
+
+        # Index the coordinate files by base name, so the directory is iterated only once
+        filesIndex = {}
+        for coordFile, fileId in self.iterFiles():
+            filesIndex.setdefault(removeBaseExt(coordFile), []).append(coordFile)
+
+        matches = []  # (tomoInd, tomo, coordFile), in tomogram order
         for tomoInd, tomo in enumerate(importTomograms.iterItems()):
             tomoName = basename(os.path.splitext(tomo.getFileName())[0])
-            for coordFile, fileId in self.iterFiles():
-                fileName = removeBaseExt(coordFile)
-
-                if tomo is not None and tomoName == fileName:
-                    objl = cv.objl_read(coordFile)
-
-                    for idx in range(len(objl)):
-                        iobjl = objl[idx]
-                        x = iobjl[DF_COORD_X]
-                        y = iobjl[DF_COORD_Y]
-                        z = iobjl[DF_COORD_Z]
-                        lbl = iobjl[DF_LABEL]
-                        score = iobjl.get(DF_SCORE, None)
-
-                        coord = Coordinate3D()
-                        coord.setVolume(tomo)
-                        coord.setObjId(coordCounter)
-                        coord.setPosition(x, y, z, BOTTOM_LEFT_CORNER)
-                        coord.setVolId(tomoInd + 1)
-                        coord.setBoxSize(boxSize)
-                        coord.setGroupId(lbl)
-                        coord.setScore(score)
-
-                        coord3DSet.append(coord)
-                        coordCounter += 1
+            for coordFile in filesIndex.get(tomoName, []):
+                matches.append((tomoInd, tomo.clone(), coordFile))
+
+        # The files are parsed in parallel, but the results are consumed in order, so the coordinate ids are the
+        # same regardless of the number of processes. Only a few files are parsed ahead of the one being registered,
+        # so the memory used does not depend on the total number of coordinates
+        coordFiles = [coordFile for _, _, coordFile in matches]
+        nProcs = min(self.numberOfThreads.get(), len(coordFiles))
+        with ProcessPoolExecutor(max_workers=max(nProcs, 1)) as executor:
+            objlDataList = _mapInOrder(executor, _readObjlData, coordFiles, 2 * nProcs) if nProcs > 1 else \
+                map(_readObjlData, coordFiles)
+            coordCounter = 1
+            for (tomoInd, tomo, coordFile), objlData in zip(matches, objlDataList):
+                objl = cv.ObjectList(data=objlData)
+                # The box size is stored in the set (Coordinate3D.setBoxSize is deprecated)
+                coordCounter += appendCoordinates(coord3DSet, tomo,
+                                                  toScipionPositions(tomo, objl.positions()),
+                                                  objl[DF_LABEL],
+                                                  scores=objl.tolist(DF_SCORE),
+                                                  volId=tomoInd + 1,
+                                                  firstObjId=coordCounter)
 
         self._defineOutputs(**{self._possibleOutputs.coordinates.name: coord3DSet})
         self._defineSourceRelation(self.importTomograms, coord3DSet)
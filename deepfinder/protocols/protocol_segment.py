@@ -24,16 +24,25 @@
 # *  e-mail address 'you@yourinstitution.email'
 # *
 # **************************************************************************
+import glob
+import hashlib
+import json
 import logging
+import os
+import threading
 from enum import Enum
-from os.path import abspath
-from pyworkflow.protocol import params, PointerParam, GPU_LIST, LEVEL_ADVANCED, STEPS_PARALLEL
+from os.path import abspath, exists
+from pyworkflow.object import String
+from pyworkflow.protocol import params, PointerParam, GPU_LIST, LEVEL_ADVANCED, STEPS_PARALLEL, ProtStreamingBase
 from pyworkflow.utils import removeBaseExt, cyanStr
 from pyworkflow.utils.properties import Message
 from tomo.objects import Tomogram, TomoMask, SetOfTomoMasks
 from tomo.protocols import ProtTomoPicking
 from deepfinder import Plugin
+from deepfinder.constants import DF_CACHE_DIR, DF_PROBABILITIES
+import deepfinder.convert as cv
 from deepfinder.protocols import ProtDeepFinderBase
+from deepfinder.scripts.script_utils import readProgress, appendProgress
 
 logger = logging.getLogger(__name__)
 
@@ -42,16 +51,25 @@ class DFSegmentOutputs(Enum):
     segmentations = SetOfTomoMasks
 
 
-class DeepFinderSegment(ProtTomoPicking, ProtDeepFinderBase):
-    """This protocol segments tomograms, using a trained neural network."""
+class DeepFinderSegment(ProtTomoPicking, ProtDeepFinderBase, ProtStreamingBase):
+    """This protocol segments tomograms, using a trained neural network. The input set can be still growing
+    (streaming): the new tomograms are segmented as they appear."""
 
     _label = 'segment'
     _possibleOutputs = DFSegmentOutputs
     stepsExecutionMode = STEPS_PARALLEL
+    BATCH_POLLING_TIME = 10  # seconds
+
+    # Probabilities output formats
+    NO_PROBABILITIES = 0
+    FLOAT16_PROBABILITIES = 1
+    UINT8_PROBABILITIES = 2
+    _probabilitiesFormats = {FLOAT16_PROBABILITIES: 'float16', UINT8_PROBABILITIES: 'uint8'}
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.tomoDict = None
+        self._batchCounter = 0
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -71,44 +89,162 @@ class DeepFinderSegment(ProtTomoPicking, ProtDeepFinderBase):
         form.addHidden(GPU_LIST, params.StringParam, default='0',
                        expertLevel=LEVEL_ADVANCED,
                        label="Choose GPU IDs",
-                       help="GPU ID, normally it is 0.")
-
-        form.addParallelSection(threads=1, mpi=0)
+                       help="GPU IDs, normally it is 0. The segmentation jobs are distributed among all the GPUs "
+                            "of the list.")
+
+        form.addParam('batchMode', params.BooleanParam,
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Segment all the tomograms in a single run?',
+                      help='If yes, the neural network is loaded only once and all the tomograms are segmented one '
+                           'after the other in the same DeepFinder run. Each segmentation is registered as soon as '
+                           'it is written. This removes most of the fixed cost per tomogram when there are many of '
+                           'them. If no, a DeepFinder run is launched for each tomogram.')
+
+        form.addParam('tiled', params.BooleanParam,
+                      default=False,
+                      label='Segment in tiles?',
+                      help='If yes, each tomogram is segmented tile by tile and the results are written to the output '
+                           'file as they are obtained, so the memory needed depends on the tile size and not on the '
+                           'tomogram size. Use it for big tomograms that do not fit in memory.')
+        form.addParam('tileSize', params.IntParam,
+                      default=256,
+                      condition='tiled',
+                      label='Tile size [pix.]',
+                      help='Size of the side of the cubic tiles. It must not be smaller than the patch size.')
+        form.addParam('tileOverlap', params.IntParam,
+                      default=48,
+                      condition='tiled',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Tile overlap [pix.]',
+                      help='Voxels shared by neighbour tiles. The predictions are blended in the overlapping '
+                           'regions to avoid seams between tiles.')
+
+        form.addParam('probabilities', params.EnumParam,
+                      display=params.EnumParam.DISPLAY_HLIST,
+                      choices=['No', 'float16', '8 bits'],
+                      default=self.NO_PROBABILITIES,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Write class probabilities?',
+                      help='The segmentations are written as int8 label maps. The probability of each class can be '
+                           'written too, next to them (segmentation_<tomogram>_probabilities.npy), as float16 values '
+                           'or quantized to 8 bits (256 levels), which take 2 and 4 times less space than float32 '
+                           'values, respectively.')
+
+        form.addParam('useCache', params.BooleanParam,
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Reuse previous segmentations?',
+                      help='If yes, the segmentations are kept in the DeepFinder cache folder (%s variable, '
+                           'SCIPION_USER_DATA/deepfinder_cache by default), indexed by the content of the tomogram '
+                           'and of the network weights and by the segmentation parameters. The tomograms already '
+                           'segmented with the same model and parameters, by this or any other protocol, are '
+                           'registered straight away instead of being segmented again. The whole tomograms are read '
+                           'once to compute their SHA-256 digests. The cached files are hard links to the ones of the '
+                           'project, so they do not use more disk space, except if the cache folder and the project '
+                           'are in different file systems: then they are copies.' % DF_CACHE_DIR)
+
+        self._defineGpuSchedulingParams(form)
+        self._defineWorkerParams(form)
+
+        form.addParallelSection(threads=2, mpi=0)
+        self._defineStreamingParams(form)
 
     # --------------------------- INSERT steps functions ----------------------
-    def _insertAllSteps(self):
-        self.__initialize()
-        closeDpes = []
-        for tsId in self.tomoDict.keys():
-            segId = self._insertFunctionStep(self.launchSegmentationStep, tsId,
-                                             prerequisites=[],
-                                             needsGPU=True)
-            cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
-                                              prerequisites=segId,
-                                              needsGPU=False)
-            closeDpes.append(cOutId)
-        # Add a final step to close the sets
-        self._insertFunctionStep(self._closeOutputSet,
-                                 prerequisites=closeDpes,
-                                 needsGPU=False)
+    def _insertSegmentationSteps(self, tsIds):
+        """ Insert the steps that segment the given tomograms and register their outputs. Returns the steps the
+        closing of the output depends on. """
+        deps = []
+        if self.batchMode.get():
+            # One batch per GPU slot, so all the devices are used. The outputs are registered by the batch steps
+            # themselves, as soon as each segmentation is written. The segmentation steps do not request a GPU to
+            # the step executor (needsGPU=False), as their devices are assigned by the protocol GpuScheduler, which
+            # allows several jobs on the same GPU
+            nBatches = len(self.getGpuList()) * self.jobsPerGpu.get()
+            for batchInd in range(min(nBatches, len(tsIds))):
+                self._batchCounter += 1
+                segId = self._insertFunctionStep(self.launchBatchSegmentationStep, tsIds[batchInd::nBatches],
+                                                 self._batchCounter,
+                                                 prerequisites=[],
+                                                 needsGPU=False)
+                deps.append(segId)
+        else:
+            for tsId in tsIds:
+                segId = self._insertFunctionStep(self.launchSegmentationStep, tsId,
+                                                 prerequisites=[],
+                                                 needsGPU=False)
+                cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
+                                                  prerequisites=segId,
+                                                  needsGPU=False)
+                deps.append(cOutId)
+        return deps
 
     # --------------------------- STEPS functions -----------------------------
-    def __initialize(self):
-        self.tomoDict = {tomo.getTsId(): tomo.clone() for tomo in self.inputTomograms.get()}
+    def stepsGeneratorStep(self):
+        """ Insert the segmentation steps of the input tomograms as they appear in the input set, until it is
+        closed. The tomograms already registered in the output (e.g. when the protocol is continued) are skipped. """
+        inTomos = self.inputTomograms.get()
+        outTomoMasks = getattr(self, self._possibleOutputs.segmentations.name, None)
+        processed = {tomoMask.getTsId() for tomoMask in outTomoMasks} if outTomoMasks else set()
+        # Batch names must not repeat the ones of previous executions, as their progress files are kept
+        self._batchCounter = len(glob.glob(self._getExtraPath('segmentation_batch_*.json')))
+        self.tomoDict = {}
+        closeDeps = []
+        for newTomos in self._iterNewInputItems(inTomos):
+            self.tomoDict.update(newTomos)
+            newTsIds = [tsId for tsId in newTomos if tsId not in processed]
+            if newTsIds:
+                logger.info(cyanStr(f'New tomograms to segment: {newTsIds}'))
+                closeDeps.extend(self._insertSegmentationSteps(newTsIds))
+
+        # Add a final step to close the sets
+        closeId = self._insertFunctionStep(self._closeOutputSet,
+                                           prerequisites=closeDeps,
+                                           needsGPU=False)
+        self._insertFunctionStep(self.stopWorkerStep,
+                                 prerequisites=closeId,
+                                 needsGPU=False)
 
     def launchSegmentationStep(self, tsId: str):
         logger.info(cyanStr(f'Segmenting step of ---> {tsId}'))
-        tomo = self.tomoDict[tsId]
-        outputFileName = self._genOutputFileName(tomo)
-
-        # Launch annotation GUI passing the tomogram file name
-        deepfinder_args = '-t ' + tomo.getFileName()
-        deepfinder_args += ' -w ' + self.weights.get().getPath()  # FIXME: Return object from pointer
-        deepfinder_args += ' -c ' + str(self.weights.get().getNbOfClasses())
-        deepfinder_args += ' -p ' + str(self.psize)
-        deepfinder_args += ' -o ' + abspath(self._getExtraPath(outputFileName))
-
-        Plugin.runDeepFinder(self, 'segment', deepfinder_args, useGPU=True)
+        if self._restoreFromCache(tsId):
+            return
+        # Done by the plugin script, which writes the compact output formats
+        self._runSegmentationScript([tsId], tsId)
+        self._storeInCache(tsId)
+
+    def launchBatchSegmentationStep(self, tsIds: list, batchInd: int):
+        logger.info(cyanStr(f'Batch segmentation step of ---> {len(tsIds)} tomograms'))
+        progressFile = self._getProgressFile(batchInd)
+        # The segmentations found in the cache are flagged as done, so they are registered and not segmented again
+        done = set(readProgress(progressFile))
+        for tsId in tsIds:
+            if tsId not in done and self._restoreFromCache(tsId):
+                appendProgress(progressFile, tsId)
+
+        # The segmentations are registered by a watcher thread while DeepFinder processes the rest of the batch
+        registered = set()
+        stopWatching = threading.Event()
+
+        def registerDone():
+            for doneTsId in readProgress(progressFile):
+                if doneTsId not in registered:
+                    self._storeInCache(doneTsId)
+                    self.createOutputStep(doneTsId)
+                    registered.add(doneTsId)
+
+        def watchProgress():
+            while not stopWatching.wait(self.BATCH_POLLING_TIME):
+                registerDone()
+
+        watcher = threading.Thread(target=watchProgress, daemon=True)
+        watcher.start()
+        try:
+            self._runSegmentationScript(tsIds, batchInd)
+        finally:
+            stopWatching.set()
+            watcher.join()
+            registerDone()
 
     def createOutputStep(self, tsId: str):
         with self._lock:
@@ -125,6 +261,9 @@ class DeepFinderSegment(ProtTomoPicking, ProtDeepFinderBase):
 
             # Link to origin tomogram:
             tomoMask.setVolName(tomo.getFileName())
+            # The class probabilities, if written, can be found by the next protocols (see cv.getProbabilitiesFile)
+            if self.probabilities.get() != self.NO_PROBABILITIES:
+                setattr(tomoMask, DF_PROBABILITIES, String(self._getExtraPath(self._genProbabilitiesFileName(tomo))))
             tomoMaskSet.append(tomoMask)
             self._store(tomoMaskSet)
 
@@ -160,6 +299,16 @@ class DeepFinderSegment(ProtTomoPicking, ProtDeepFinderBase):
 
         return methodsMsgs
 
+    def _validate(self):
+        errorMsg = []
+        self._validateThreads(errorMsg)
+        if self.tiled.get():
+            if self.tileSize.get() < self.psize.get():
+                errorMsg.append('The tile size cannot be smaller than the patch size.')
+            if not 0 <= self.tileOverlap.get() < self.tileSize.get() / 2:
+                errorMsg.append('The tile overlap must be positive and smaller than half the tile size.')
+        return errorMsg
+
     # --------------------------- UTILS functions ----------------------
     def _genOutputData(self, fileList, suffix):
         outputSetOfTomo = self._createSetOfTomograms(suffix=suffix)
@@ -172,10 +321,96 @@ class DeepFinderSegment(ProtTomoPicking, ProtDeepFinderBase):
 
         return outputSetOfTomo
 
+    def _getOutputFiles(self, tomo):
+        """ Files written by the segmentation of the given tomogram. """
+        outputFiles = [self._genOutputFileName(tomo)]
+        if self.probabilities.get() != self.NO_PROBABILITIES:
+            outputFiles.append(self._genProbabilitiesFileName(tomo))
+        return [abspath(self._getExtraPath(fileName)) for fileName in outputFiles]
+
+    def _getCachedOutputFiles(self, tomo):
+        """ Files of the segmentation cache corresponding to the output files of the given tomogram. They are named
+        after the content of the tomogram and of the weights and after the parameters that change the result. """
+        cacheDir = Plugin.getCacheDir()
+        tomoHash, weightsHash = cv.getCachedHashes(cacheDir, [tomo.getFileName(), self.weights.get().getPath()])
+        settings = [tomoHash, weightsHash, self.weights.get().getNbOfClasses(), self.psize.get()]
+        if self.tiled.get():
+            settings += [self.tileSize.get(), self.tileOverlap.get()]
+        key = hashlib.sha256(json.dumps(settings).encode()).hexdigest()
+        cachedFiles = [os.path.join(cacheDir, 'segmentations', key + '.mrc')]
+        if self.probabilities.get() != self.NO_PROBABILITIES:
+            probabilitiesFormat = self._probabilitiesFormats[self.probabilities.get()]
+            cachedFiles.append(os.path.join(cacheDir, 'segmentations',
+                                            f'{key}_probabilities_{probabilitiesFormat}.npy'))
+        return cachedFiles
+
+    def _restoreFromCache(self, tsId):
+        """ Get the outputs of the given tomogram from the segmentation cache. Returns False if they are not
+        there. """
+        if not self.useCache.get():
+            return False
+        tomo = self.tomoDict[tsId]
+        cachedFiles = self._getCachedOutputFiles(tomo)
+        if not all(exists(cachedFile) for cachedFile in cachedFiles):
+            return False
+        logger.info(cyanStr(f'{tsId} ---> segmentation found in the cache'))
+        for cachedFile, outputFile in zip(cachedFiles, self._getOutputFiles(tomo)):
+            cv.linkOrCopy(cachedFile, outputFile)
+        return True
+
+    def _storeInCache(self, tsId):
+        """ Add the outputs of the given tomogram to the segmentation cache. They may be hard links to the same files
+        than the outputs, which is safe as the segment_batch script never writes over an existing output in place
+        (it replaces it with a new file). """
+        if not self.useCache.get():
+            return
+        tomo = self.tomoDict[tsId]
+        for outputFile, cachedFile in zip(self._getOutputFiles(tomo), self._getCachedOutputFiles(tomo)):
+            if not exists(cachedFile):
+                os.makedirs(os.path.dirname(cachedFile), exist_ok=True)
+                cv.linkOrCopy(outputFile, cachedFile)
+
+    def _getProgressFile(self, batchName):
+        return abspath(self._getExtraPath(f'segmentation_batch_{batchName}_done.txt'))
+
+    def _runSegmentationScript(self, tsIds, batchName):
+        """ Segment the given tomograms with the segment_batch script, which loads the network once for all of
+        them and appends each tsId to the progress file once its segmentation is written. """
+        manifest = []
+        for tsId in tsIds:
+            tomo = self.tomoDict[tsId]
+            manifest.append({'tsId': tsId,
+                             'tomo': abspath(tomo.getFileName()),
+                             'output': abspath(self._getExtraPath(self._genOutputFileName(tomo))),
+                             'probabilities': abspath(self._getExtraPath(self._genProbabilitiesFileName(tomo)))})
+        manifestFile = abspath(self._getExtraPath(f'segmentation_batch_{batchName}.json'))
+        with open(manifestFile, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        deepfinder_args = '-m ' + manifestFile
+        deepfinder_args += ' -w ' + self.weights.get().getPath()
+        deepfinder_args += ' -c ' + str(self.weights.get().getNbOfClasses())
+        deepfinder_args += ' -p ' + str(self.psize)
+        deepfinder_args += ' --progress ' + self._getProgressFile(batchName)
+        if self.tiled.get():
+            deepfinder_args += ' --tile-size %i --tile-overlap %i' % (self.tileSize.get(), self.tileOverlap.get())
+        if self.probabilities.get() != self.NO_PROBABILITIES:
+            deepfinder_args += ' --probabilities ' + self._probabilitiesFormats[self.probabilities.get()]
+
+        with self.getGpuScheduler().device() as gpuId:
+            logger.info(cyanStr(f'Batch {batchName} ---> GPU {gpuId}'))
+            Plugin.runDeepFinderScript(self, 'segment_batch', deepfinder_args, gpuId=gpuId)
+
     @staticmethod
     def _genOutputFileName(tomo):
         return 'segmentation_' + removeBaseExt(tomo.getFileName()) + '.mrc'
 
+    @staticmethod
+    def _genProbabilitiesFileName(tomo):
+        """ Class probabilities of a tomogram. Their path is stored in the output TomoMask (see
+        convert.getProbabilitiesFile), and they can be read with convert.mmapProbabilities. """
+        return 'segmentation_' + removeBaseExt(tomo.getFileName()) + '_probabilities.npy'
+
     def createOutputSet(self) -> SetOfTomoMasks:
         tomoMaskSet = getattr(self, self._possibleOutputs.segmentations.name, None)
         if tomoMaskSet:
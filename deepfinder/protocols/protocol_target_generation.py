@@ -26,8 +26,9 @@
 # **************************************************************************
 from enum import Enum
 from os.path import abspath
+import numpy as np
 from pwem.convert.headers import fixVolume
-from pyworkflow.protocol import params, PointerParam, STEPS_PARALLEL
+from pyworkflow.protocol import params, PointerParam, STEPS_PARALLEL, LEVEL_ADVANCED
 from pyworkflow.utils import removeBaseExt
 from pyworkflow.utils.properties import Message
 from pwem.protocols import EMProtocol
@@ -35,6 +36,7 @@ from tomo.protocols import ProtTomoBase
 from tomo.objects import TomoMask, SetOfTomoMasks
 from deepfinder import Plugin
 import deepfinder.convert as cv
+from deepfinder.processing import generateSphereTargets
 from deepfinder.protocols import ProtDeepFinderBase
 import logging
 logger = logging.getLogger(__name__)
@@ -80,6 +82,14 @@ class DeepFinderGenerateTrainingTargetsSpheres(EMProtocol, ProtDeepFinderBase, P
                       help='Sphere radius, in voxels, per class. Should be separated by coma as follows: '
                            'Rclass1,Rclass2, ...')
 
+        form.addParam('nativeTargets', params.BooleanParam,
+                      default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Generate the targets in Scipion?',
+                      help='If yes, the spheres are painted directly in Scipion, without launching DeepFinder for '
+                           'each tomogram. The result is the same, but it is much faster and it does not require '
+                           'the DeepFinder environment. If no, the DeepFinder program generate_target is used.')
+
         form.addParallelSection(threads=4, mpi=1)
 
     # --------------------------- STEPS functions ------------------------------
@@ -103,13 +113,22 @@ class DeepFinderGenerateTrainingTargetsSpheres(EMProtocol, ProtDeepFinderBase, P
         fname_params = tomoDict[self.PARAMS_XML]
 
         logger.info(f'Target generation step of ---> {tomo.getTsId()}')
+        radius_list = self._getRadiusList()
+        dimX, dimY, dimZ = tomo.getDimensions()
+
+        if self.nativeTargets.get():
+            # The spheres are painted directly on the memory-mapped output volume
+            target = cv.createVolume(self.getTargetName(tomo), (dimZ, dimY, dimX), dtype=np.int8,
+                                     voxelSize=tomo.getSamplingRate())
+            generateSphereTargets(objl_tomo, target.shape, radius_list, target=target)
+            target.flush()
+            return
+
         # Prepare parameter file for DeepFinder. First, set parameters that are common to all targets to be generated:
         param = cv.ParamsGenTarget()
         # Set strategy:
         param.strategy = 'spheres'
         # Set radius list:
-        radius_list_string = self.sphereRadii.get()
-        radius_list = [int(r) for r in radius_list_string.split(',')]
         param.radius_list = radius_list
 
         # Get objl for tomogram and save objl to extra folder:
@@ -119,7 +138,6 @@ class DeepFinderGenerateTrainingTargetsSpheres(EMProtocol, ProtDeepFinderBase, P
         param.path_objl = fname_objl
 
         # Set tomogram size:
-        dimX, dimY, dimZ = tomo.getDimensions()
         param.tomo_size = (dimZ, dimY, dimX)
 
         # Set path to where write the generated target:
@@ -143,7 +161,8 @@ class DeepFinderGenerateTrainingTargetsSpheres(EMProtocol, ProtDeepFinderBase, P
         for tomoDict in tomoDictList:
             tomo = tomoDict[self.TOMO]
             tomoMaskName = self.getTargetName(tomo)
-            fixVolume(tomoMaskName)
+            if not self.nativeTargets.get():
+                fixVolume(tomoMaskName)
             target = TomoMask()
             target.cleanObjId()
             target.copyInfo(tomo)
@@ -156,6 +175,9 @@ class DeepFinderGenerateTrainingTargetsSpheres(EMProtocol, ProtDeepFinderBase, P
         self._defineOutputs(**{self._possibleOutputs.segmentedTargets.name: targetSet})
         self._defineSourceRelation(self.inputCoordinates, targetSet)
 
+    def _getRadiusList(self):
+        return [int(r) for r in self.sphereRadii.get().split(',')]
+
     def getTargetName(self, tomo):
         return self._getExtraPath('target_' + removeBaseExt(tomo.getFileName()) + '.mrc')
 
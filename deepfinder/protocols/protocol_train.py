@@ -25,17 +25,20 @@
 # *
 # **************************************************************************
 import glob
+import json
 from enum import Enum
-from os.path import abspath
+from os.path import abspath, exists
 import numpy as np
 
 from deepfinder import Plugin
+from deepfinder.constants import DF_CACHE_DIR, CHECKPOINTS_MANIFEST
 from pwem.protocols import EMProtocol
-from pyworkflow.protocol import params, PointerParam, GPU_LIST, LEVEL_ADVANCED, FloatParam, GT, LT
+from pyworkflow.protocol import params, PointerParam, GPU_LIST, LEVEL_ADVANCED, FloatParam, GT, LT, GE
 from pyworkflow.utils import removeBaseExt
 from pyworkflow.utils.properties import Message
 import deepfinder.convert as cv
 from deepfinder.objects import DeepFinderNet
+from deepfinder.processing import writeSamplingIndex, getSamplingIndexFile
 from deepfinder.protocols import ProtDeepFinderBase
 from tomo.protocols import ProtTomoBase
 from tomo.objects import SetOfTomoMasks
@@ -105,6 +108,15 @@ class DeepFinderTrain(EMProtocol, ProtDeepFinderBase, ProtTomoBase):
                       important=True,
                       help='Select coordinate set.')
 
+        form.addParam('inputModel', PointerParam,
+                      pointerClass='DeepFinderNet',
+                      label='Initial model (optional)',
+                      allowsNull=True,
+                      help='If provided, the training starts from the weights of this model instead of from random '
+                           'ones (fine-tuning), so a model can be updated with new data in a few epochs. It must have '
+                           'the same number of classes. An interrupted training is always resumed from its last '
+                           'epoch when the protocol is continued.')
+
         form.addSection(label='Training Parameters')
         form.addParam('psize', params.EnumParam,
                       display=params.EnumParam.DISPLAY_COMBO,
@@ -145,6 +157,43 @@ class DeepFinderTrain(EMProtocol, ProtDeepFinderBase, ProtTomoBase):
                       help='(in voxels) Applied to positions in object list when sampling patches. Enhances network '
                            'robustness. Make sure that objects are still contained in patches when applying shift.')
 
+        form.addParam('precomputedSampling', params.BooleanParam,
+                      default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Use precomputed sampling index?',
+                      help='If yes, the valid patch positions and the class balance of the training and validation '
+                           'objects are computed once and stored next to their object lists, so each patch is drawn '
+                           'in constant time, and the validation patches are drawn only once and kept in memory for '
+                           'all the epochs. Otherwise, DeepFinder training program is used.')
+
+        form.addParam('keepBest', params.IntParam,
+                      default=3,
+                      condition='precomputedSampling',
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Keep best N epochs',
+                      help='Number of epoch weights kept by lowest validation loss. The weights of the other epochs '
+                           'are deleted during the training, unless they are kept by the next parameter.')
+
+        form.addParam('keepEvery', params.IntParam,
+                      default=10,
+                      condition='precomputedSampling',
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Keep every k-th epoch',
+                      help='The weights of every k-th epoch are kept too (0 for none). The weights of the last '
+                           'epoch are always kept.')
+
+        form.addParam('directRead', params.BooleanParam,
+                      default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Read patches directly from disk?',
+                      help='If yes, the tomograms and targets are converted into chunked HDF5 files, and only the '
+                           'patches of each batch are read from them during the training, instead of loading all '
+                           'the volumes in memory. The converted files are kept in the DeepFinder cache folder '
+                           '(%s variable), named after the content of their source, so they are reused by any '
+                           'other training with the same data.' % DF_CACHE_DIR)
+
         form.addHidden(GPU_LIST, params.StringParam, default='0',
                        expertLevel=LEVEL_ADVANCED,
                        label="Choose GPU IDs",
@@ -165,7 +214,7 @@ class DeepFinderTrain(EMProtocol, ProtDeepFinderBase, ProtTomoBase):
         else:
             nTomoMasks = len(tomoMasksTrain)
             nValData = round(self.valDataFraction.get() * nTomoMasks)
-            randPermIdxs = np.random.permutation(range(nTomoMasks))
+            randPermIdxs = self._getValidationSplit(nTomoMasks)
             tomoMasksList = [tomoMask.clone() for tomoMask in tomoMasksTrain]
             tomoMasksListSorted = [tomoMasksList[i] for i in randPermIdxs]  # List of tomo masks [validation, training] after randomization
             path_tomos, path_targets = self._getPathListsFromTomoMaskSet(tomoMasksListSorted)
@@ -177,6 +226,12 @@ class DeepFinderTrain(EMProtocol, ProtDeepFinderBase, ProtTomoBase):
         fname_objl_valid = abspath(self._getExtraPath('objl_valid.xml'))
         cv.objl_write(objl_valid, fname_objl_valid)
 
+        if self.precomputedSampling.get():
+            tomoShapes = [cv.getVolumeInfo(tomoFile).dims[::-1] for tomoFile in path_tomos]
+            patchSizes = [int(psize) for psize in PSIZE_CHOICES]
+            for objl, objlFile in zip([objl_train, objl_valid], [fname_objl_train, fname_objl_valid]):
+                writeSamplingIndex(objl, tomoShapes, patchSizes, self.rndShift.get(), getSamplingIndexFile(objlFile))
+
         # Get number of classes from objl, and store as attribute (useful for output step):
         self.nClass = len(cv.objl_get_labels(objl_train)) + 1  # (+1 for background class)
 
@@ -194,7 +249,11 @@ class DeepFinderTrain(EMProtocol, ProtDeepFinderBase, ProtTomoBase):
         params.nepochs = self.epochs.get()
         params.steps_per_e = self.stepsPerE.get()
         params.steps_per_v = self.stepsPerV.get()
-        params.flag_direct_read = False  # in current deepfinder version only works with tomos/targets stored as h5
+        # In current deepfinder version direct read only works with tomos/targets stored as h5
+        params.flag_direct_read = self.directRead.get()
+        if params.flag_direct_read:
+            params.path_tomo = self._getCachedH5Files(path_tomos)
+            params.path_target = self._getCachedH5Files(path_targets)
         params.flag_bootstrap = self.bootstrap.get()
         params.rnd_shift = self.rndShift.get()
 
@@ -203,10 +262,24 @@ class DeepFinderTrain(EMProtocol, ProtDeepFinderBase, ProtTomoBase):
 
         # Launch DeepFinder training:
         deepfinder_args = '-p ' + fname_params
-        Plugin.runDeepFinder(self, 'train', deepfinder_args, useGPU=True)
+        if self.precomputedSampling.get():
+            deepfinder_args += ' --train-index %s --valid-index %s' % (getSamplingIndexFile(fname_objl_train),
+                                                                      getSamplingIndexFile(fname_objl_valid))
+            deepfinder_args += ' --resume --keep-best %i --keep-every %i' % (self.keepBest.get(), self.keepEvery.get())
+            inputModel = self.inputModel.get()
+            if inputModel:
+                if inputModel.getNbOfClasses() != self.nClass:
+                    raise Exception('The initial model has %i classes (background included), while the training '
+                                    'data has %i.' % (inputModel.getNbOfClasses(), self.nClass))
+                deepfinder_args += ' --init-weights %s' % abspath(inputModel.getPath())
+            Plugin.runDeepFinderScript(self, 'train', deepfinder_args, useGPU=True)
+        else:
+            Plugin.runDeepFinder(self, 'train', deepfinder_args, useGPU=True)
 
     def createOutputStep(self):
-        trainingModels = sorted(glob.glob(self._getExtraPath('net_weights_*.h5')), reverse=True)
+        trainingModels = self._getRetainedModels()
+        if trainingModels is None:
+            trainingModels = sorted(glob.glob(self._getExtraPath('net_weights_*.h5')), reverse=True)
         for trainingModel in trainingModels:
             netWeights = DeepFinderNet(path=abspath(trainingModel),
                                        noClasses=self.nClass)
@@ -215,6 +288,43 @@ class DeepFinderTrain(EMProtocol, ProtDeepFinderBase, ProtTomoBase):
             self._defineSourceRelation(self.tomoMasksTrain, netWeights)
 
     # --------------------------- UTILITY functions -------------------------------- #
+    def _getRetainedModels(self):
+        """ Weights kept by the retention policy of the training, best validation loss first, or None if the
+        training did not apply one. """
+        manifestFile = self._getExtraPath(CHECKPOINTS_MANIFEST)
+        if not exists(manifestFile):
+            return None
+        with open(manifestFile) as f:
+            return [self._getExtraPath(entry['file']) for entry in json.load(f)]
+
+    def _getValidationSplit(self, nTomoMasks):
+        """ Random order of the training tomo masks ([validation, training]). It is stored, so a resumed training
+        keeps validating with the same tomograms. A new one is generated if the number of tomo masks has changed
+        since it was stored. """
+        splitFile = self._getExtraPath('validation_split.json')
+        if exists(splitFile):
+            with open(splitFile) as f:
+                split = json.load(f)
+            if split['nTomoMasks'] == nTomoMasks:
+                return split['order']
+        randPermIdxs = np.random.permutation(range(nTomoMasks)).tolist()
+        with open(splitFile, 'w') as f:
+            json.dump({'nTomoMasks': nTomoMasks, 'order': randPermIdxs}, f)
+        return randPermIdxs
+
+    def _getCachedH5Files(self, fileList):
+        """ HDF5 copies, in the DeepFinder cache, of the given MRC files. The ones that are not in the cache yet are
+        converted. """
+        h5Files = cv.getCachedFiles(Plugin.getCacheDir(), fileList, '.h5')
+        manifest = [{'tsId': removeBaseExt(mrcFile), 'tomo': mrcFile, 'output': h5File}
+                    for mrcFile, h5File in zip(fileList, h5Files) if not exists(h5File)]
+        if manifest:
+            manifestFile = abspath(self._getExtraPath('h5_conversion.json'))
+            with open(manifestFile, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            Plugin.runDeepFinderScript(self, 'convert_h5', '-m ' + manifestFile)
+        return h5Files
+
     @staticmethod
     def _decodeContValue(idx):
         """Decode the psize value and represent it as expected by DeepFinder"""
@@ -307,6 +417,8 @@ class DeepFinderTrain(EMProtocol, ProtDeepFinderBase, ProtTomoBase):
                             'be at least 2.')
         if self.useSpecificValidation.get() and not valTomoMasks:
             errorMsg.append('Please provide a validation set.')
+        if self.inputModel.get() and not self.precomputedSampling.get():
+            errorMsg.append('An initial model can only be used with the precomputed sampling index.')
 
         return errorMsg
 
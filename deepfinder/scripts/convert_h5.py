@@ -0,0 +1,78 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Converts MRC volumes into chunked HDF5 files, so DeepFinder training can read its patches directly from disk
+(flag_direct_read) instead of loading all the tomograms and targets in memory. The volumes are listed in a manifest
+file (see script_utils.readManifest) with the keys tsId, tomo (MRC file) and output (HDF5 file). The data is copied
+slab by slab from the memory-mapped MRC, and each output is written to a temporary file that is renamed once
+complete, so an interrupted conversion never leaves a truncated file behind. The existing outputs are not converted
+again.
+"""
+import argparse
+import os
+
+import numpy as np
+
+from script_utils import mmapVolume, readManifest
+
+DATASET_NAME = 'dataset'  # Key used by DeepFinder to read and write its HDF5 volumes
+CHUNK_SIZE = 32  # Patches are read at random positions, so small cubic chunks minimize the data read for each one
+
+
+def convertVolume(inFile, outFile, chunkSize=CHUNK_SIZE):
+    import h5py
+    data = mmapVolume(inFile)
+    chunks = tuple(min(chunkSize, dim) for dim in data.shape)
+    tmpFile = '%s.%d.tmp' % (outFile, os.getpid())
+    try:
+        with h5py.File(tmpFile, 'w') as h5:
+            dataset = h5.create_dataset(DATASET_NAME, shape=data.shape, dtype=data.dtype, chunks=chunks)
+            # One slab of chunks at a time, so each chunk is written only once
+            for z in range(0, data.shape[0], chunks[0]):
+                dataset[z:z + chunks[0]] = np.asarray(data[z:z + chunks[0]])
+        os.replace(tmpFile, outFile)
+    finally:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert MRC volumes into chunked HDF5 files.')
+    parser.add_argument('--df-home', required=True, help='DeepFinder installation folder.')
+    parser.add_argument('-m', '--manifest', required=True, help='JSON file with the volumes to convert.')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Size of the HDF5 chunks (voxels).')
+    args = parser.parse_args()
+
+    for entry in readManifest(args.manifest):
+        if os.path.exists(entry['output']):
+            print('%s: already converted' % entry['tsId'], flush=True)
+            continue
+        print('%s: converting %s' % (entry['tsId'], entry['tomo']), flush=True)
+        convertVolume(entry['tomo'], entry['output'], args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
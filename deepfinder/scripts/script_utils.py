@@ -0,0 +1,99 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Helpers shared by the scripts executed in the DeepFinder environment.
+"""
+import importlib.util
+import json
+import os
+import sys
+
+
+def _loadPluginConstants():
+    """ constants.py of this plugin, which defines the names and values shared with the Scipion side. It is loaded
+    from its path, as the name deepfinder refers to the DeepFinder package in this environment. """
+    constantsFile = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'constants.py')
+    spec = importlib.util.spec_from_file_location('deepfinder_plugin_constants', constantsFile)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+_constants = _loadPluginConstants()
+PROBABILITIES_QUANTIZATION_LEVELS = _constants.PROBABILITIES_QUANTIZATION_LEVELS
+CHECKPOINTS_MANIFEST = _constants.CHECKPOINTS_MANIFEST
+TRAINING_METRICS_FILE = _constants.TRAINING_METRICS_FILE
+
+
+def addDeepFinderToPath(dfHome):
+    """ Make the DeepFinder package of the given installation importable. """
+    dfHome = os.path.abspath(dfHome)
+    if dfHome not in sys.path:
+        sys.path.insert(0, dfHome)
+
+
+def getWorkerCache(scriptGlobals):
+    """ Cache kept between jobs when the script is executed by the persistent DeepFinder worker (see
+    worker_server.py). An empty dict, which is discarded at the end of the script, is returned otherwise. """
+    return scriptGlobals.get('DF_WORKER_CACHE', {})
+
+
+def readManifest(manifestFile):
+    """ Read a manifest of volumes to be processed: a JSON list of dicts with, at least, the keys tsId, tomo and
+    output. """
+    with open(manifestFile) as f:
+        return json.load(f)
+
+
+def readProgress(progressFile):
+    """ tsIds already processed, as written by appendProgress. """
+    if not os.path.exists(progressFile):
+        return []
+    with open(progressFile) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def appendProgress(progressFile, tsId):
+    """ Flag the given tsId as processed. This must be done once its output is completely written, as the protocol
+    registers it as soon as it appears in the progress file. """
+    with open(progressFile, 'a') as f:
+        f.write(tsId + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def mmapVolume(filename):
+    """ Read-only memory-mapped data of an MRC volume, indexed as (z, y, x). Unlike mrcfile.open, nothing is loaded
+    until it is used. """
+    import mrcfile
+    import numpy as np
+    from mrcfile.utils import data_dtype_from_header, data_shape_from_header
+    with mrcfile.open(filename, header_only=True, permissive=True) as mrc:
+        header = mrc.header
+        shape = data_shape_from_header(header)
+        dtype = data_dtype_from_header(header)
+        offset = header.nbytes + int(header.nsymbt)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
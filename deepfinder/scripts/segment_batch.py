@@ -0,0 +1,282 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Segments a batch of tomograms with a DeepFinder model that is loaded only once. The tomograms are listed in a
+manifest file (see script_utils.readManifest) and processed one after the other. The tsId of each tomogram is
+appended to the progress file as soon as its segmentation has been written, so the protocol can register it while the
+rest of the batch is being processed. Tomograms already present in the progress file are skipped, which allows
+resuming an interrupted batch. With --tile-size, each tomogram is segmented tile by tile (see segmentTomogramTiled).
+
+The label map is written as an int8 MRC. With --probabilities, the class probabilities are written too, next to it, as
+a (z, y, x, class) .npy array of float16 values or of uint8 values quantized to 1/255 (see encodeProbabilities).
+
+The outputs are written to temporary files that are then moved over the final names, so an existing output file is
+replaced instead of being overwritten in place. Other links to its previous content (e.g. an entry of the segmentation
+cache) are not modified.
+"""
+import argparse
+import os
+
+import numpy as np
+
+from script_utils import addDeepFinderToPath, getWorkerCache, readManifest, readProgress, appendProgress, \
+    mmapVolume, PROBABILITIES_QUANTIZATION_LEVELS
+
+
+def getSegmenter(cache, weights, nClasses, patchSize):
+    from deepfinder.inference import Segment
+    key = ('segment', os.path.abspath(weights), nClasses, patchSize)
+    if key not in cache:
+        cache[key] = Segment(Ncl=nClasses, path_weights=weights, patch_size=patchSize)
+    return cache[key]
+
+
+PROBABILITY_FORMATS = ('float16', 'uint8')
+
+
+def encodeProbabilities(probabilities, dtype):
+    """ Probabilities in the compact format of the given type: float16, or uint8 quantized in
+    PROBABILITIES_QUANTIZATION_LEVELS steps. """
+    if dtype == 'uint8':
+        return np.rint(np.clip(probabilities, 0, 1) * PROBABILITIES_QUANTIZATION_LEVELS).astype(np.uint8)
+    return probabilities.astype(np.float16)
+
+
+def writeLabelMap(labelmap, outputFile):
+    import mrcfile
+    with mrcfile.new(outputFile, overwrite=True) as mrc:
+        mrc.set_data(labelmap.astype(np.int8))
+
+
+def segmentTomogram(seg, tomoFile, outputFile, probabilitiesFile=None, probabilitiesFormat=None):
+    # Mapped instead of loaded: the raw data is not kept in memory next to the normalized copy made by DeepFinder
+    data = mmapVolume(tomoFile)
+    scoremaps = seg.launch(data)
+    writeLabelMap(np.argmax(scoremaps, axis=-1), outputFile)
+    if probabilitiesFile:
+        np.save(probabilitiesFile, encodeProbabilities(scoremaps, probabilitiesFormat))
+
+
+def getVolumeStats(data, slabSize=16):
+    """ Mean and standard deviation of a (memory-mapped) volume, computed by blocks of slabSize z and y lines. """
+    total, totalSq = 0., 0.
+    for z in range(0, data.shape[0], slabSize):
+        for y in range(0, data.shape[1], slabSize):
+            block = np.asarray(data[z:z + slabSize, y:y + slabSize], dtype=np.float64)
+            total += block.sum()
+            totalSq += np.square(block).sum()
+    mean = total / data.size
+    return mean, np.sqrt(max(totalSq / data.size - mean ** 2, 0.))
+
+
+def getTileStarts(dim, tileSize, overlap):
+    """ Start of the tiles along one axis. Consecutive tiles share overlap voxels and the last one ends at dim. """
+    if dim <= tileSize:
+        return [0]
+    starts = list(range(0, dim - tileSize + 1, tileSize - overlap))
+    if starts[-1] + tileSize < dim:
+        starts.append(dim - tileSize)
+    return starts
+
+
+def getBlendingWindow(start, end, dim, overlap):
+    """ 1D blending weights of a tile: a linear ramp in the overlapping borders (not in the volume borders), so the
+    predictions of neighbour tiles are cross-faded. """
+    window = np.ones(end - start, dtype=np.float32)
+    nRamp = min(overlap, end - start)
+    ramp = np.arange(1, nRamp + 1, dtype=np.float32) / (nRamp + 1)
+    if nRamp and start > 0:
+        window[:nRamp] = np.minimum(window[:nRamp], ramp)
+    if nRamp and end < dim:
+        window[-nRamp:] = np.minimum(window[-nRamp:], ramp[::-1])
+    return window
+
+
+def iterBlocks(shape, blockSize):
+    """ Slices of the blocks of blockSize x blockSize voxels that cover a (y, x) section of the given shape. """
+    for y in range(0, shape[0], blockSize):
+        for x in range(0, shape[1], blockSize):
+            yield slice(y, y + blockSize), slice(x, x + blockSize)
+
+
+def getSegmentParams(seg):
+    """ Patch size, crop and overlap used by DeepFinder's Segment.launch. They are read from the segmenter, so the
+    tiles are predicted exactly as DeepFinder would do. """
+    missing = [attr for attr in ('P', 'Ncl', 'pcrop', 'poverlap', 'net') if not hasattr(seg, attr)]
+    if missing:
+        raise AttributeError('The DeepFinder Segment object does not have the attributes %s needed by the tiled '
+                             'segmentation. Please check the DeepFinder version.' % ', '.join(missing))
+    return seg.P, seg.pcrop, seg.poverlap
+
+
+def predictTile(seg, tile):
+    """ Score maps of an already normalized tile. It is the patch-wise prediction done by DeepFinder's
+    Segment.launch (same patch centers, crop and overlap averaging), without the normalization. """
+    P, pcrop, poverlap = getSegmentParams(seg)
+    l = P // 2
+    lcrop = l - pcrop
+    step = 2 * l + 1 - poverlap
+
+    data = np.pad(tile, pcrop, mode='constant', constant_values=0)
+    dim = data.shape
+    centers = []
+    for d in dim:
+        axisCenters = list(range(l, d - l, step))
+        if not axisCenters or axisCenters[-1] < d - l:
+            axisCenters.append(d - l)
+        centers.append(axisCenters)
+
+    pred = np.zeros(dim + (seg.Ncl,), dtype=np.float32)
+    norm = np.zeros(dim, dtype=np.float32)
+    for x in centers[0]:
+        for y in centers[1]:
+            for z in centers[2]:
+                patch = data[x - l:x + l, y - l:y + l, z - l:z + l]
+                patchPred = seg.net.predict(np.reshape(patch, (1, P, P, P, 1)), batch_size=1)
+                pred[x - lcrop:x + lcrop, y - lcrop:y + lcrop, z - lcrop:z + lcrop] += \
+                    patchPred[0, l - lcrop:l + lcrop, l - lcrop:l + lcrop, l - lcrop:l + lcrop, :]
+                norm[x - lcrop:x + lcrop, y - lcrop:y + lcrop, z - lcrop:z + lcrop] += 1
+
+    pred = pred[pcrop:dim[0] - pcrop, pcrop:dim[1] - pcrop, pcrop:dim[2] - pcrop]
+    norm = norm[pcrop:dim[0] - pcrop, pcrop:dim[1] - pcrop, pcrop:dim[2] - pcrop]
+    return pred / norm[..., None]
+
+
+def segmentTomogramTiled(seg, tomoFile, outputFile, tileSize, overlap, probabilitiesFile=None,
+                         probabilitiesFormat=None):
+    """ Segment a tomogram tile by tile. The tiles are processed in slabs along z, and the blended score maps of the
+    current slab (plus the overlap carried from the previous one) are accumulated in a scratch file next to the
+    output, one slab deep. Everything is read and written by blocks of the tile size, so the memory used depends only
+    on the tile size and on the number of classes. The voxels that no later slab can reach are written straight to
+    the output files, and the scratch file is removed at the end. """
+    import mrcfile
+    data = mmapVolume(tomoFile)
+    shape = data.shape
+    mean, std = getVolumeStats(data)
+    if std == 0:  # Constant volume, the normalized tiles are all zeros
+        std = 1.
+    tileStarts = [getTileStarts(dim, tileSize, overlap) for dim in shape]
+    nTiles = np.prod([len(starts) for starts in tileStarts])
+    iTile = 0
+    probabilities = None
+    if probabilitiesFile:
+        probabilities = np.lib.format.open_memmap(probabilitiesFile, mode='w+', shape=shape + (seg.Ncl,),
+                                                  dtype=probabilitiesFormat)
+    scoresFile = os.path.splitext(outputFile)[0] + '.scores.tmp'
+    scores = np.memmap(scoresFile, dtype=np.float32, mode='w+',
+                       shape=(min(tileSize, shape[0]),) + shape[1:] + (seg.Ncl,))
+    try:
+        with mrcfile.new_mmap(outputFile, shape=shape, mrc_mode=0, overwrite=True) as mrc:
+            nCarried = 0  # z planes at the beginning of scores carried from the previous slab
+            zStarts = tileStarts[0]
+            for iSlab, z0 in enumerate(zStarts):
+                z1 = min(z0 + tileSize, shape[0])
+                if iSlab > 0:  # The scratch file is created filled with zeros
+                    for ys, xs in iterBlocks(shape[1:], tileSize):
+                        scores[nCarried:z1 - z0, ys, xs] = 0
+                zWindow = getBlendingWindow(z0, z1, shape[0], overlap)
+                for y0 in tileStarts[1]:
+                    for x0 in tileStarts[2]:
+                        iTile += 1
+                        print('Tile %d/%d' % (iTile, nTiles), flush=True)
+                        y1, x1 = [min(start + tileSize, dim) for start, dim in zip((y0, x0), shape[1:])]
+                        tile = (np.asarray(data[z0:z1, y0:y1, x0:x1], dtype=np.float32) - mean) / std
+                        window = (zWindow[:, None, None] *
+                                  getBlendingWindow(y0, y1, shape[1], overlap)[None, :, None] *
+                                  getBlendingWindow(x0, x1, shape[2], overlap)[None, None, :])
+                        scores[:z1 - z0, y0:y1, x0:x1] += predictTile(seg, tile) * window[..., None]
+
+                # The voxels before the start of the next slab are final
+                zEnd = zStarts[iSlab + 1] if iSlab + 1 < len(zStarts) else z1
+                for ys, xs in iterBlocks(shape[1:], tileSize):
+                    done = np.array(scores[:zEnd - z0, ys, xs])
+                    # The weights are positive, so the arg max of the weighted sum is the one of the blended scores
+                    mrc.data[z0:zEnd, ys, xs] = np.argmax(done, axis=-1).astype(np.int8)
+                    if probabilities is not None:
+                        # The probabilities of each tile add up to 1, so the sum of the weighted ones is the total
+                        # weight
+                        probabilities[z0:zEnd, ys, xs] = encodeProbabilities(
+                            done / done.sum(axis=-1, keepdims=True), probabilitiesFormat)
+                    # Move the overlap with the next slab to the beginning of the scratch file
+                    scores[:z1 - zEnd, ys, xs] = np.array(scores[zEnd - z0:z1 - z0, ys, xs])
+                nCarried = z1 - zEnd
+    finally:
+        del scores
+        os.remove(scoresFile)
+    if probabilities is not None:
+        probabilities.flush()
+        del probabilities
+
+
+def getTmpFileName(filename):
+    """ Temporary file name with the same extension (numpy appends .npy to the names without it). """
+    base, ext = os.path.splitext(filename)
+    return '%s.%d.tmp%s' % (base, os.getpid(), ext)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Segment a batch of tomograms with DeepFinder.')
+    parser.add_argument('--df-home', required=True, help='DeepFinder installation folder.')
+    parser.add_argument('-m', '--manifest', required=True, help='JSON file with the tomograms to segment.')
+    parser.add_argument('-w', '--weights', required=True, help='Network weights file (.h5).')
+    parser.add_argument('-c', '--nclasses', type=int, required=True, help='Number of classes (background included).')
+    parser.add_argument('-p', '--psize', type=int, required=True, help='Patch size.')
+    parser.add_argument('--progress', required=True, help='File where the segmented tsIds are appended.')
+    parser.add_argument('--tile-size', type=int, default=0,
+                        help='If greater than 0, the tomograms are segmented in tiles of this size (voxels per side).')
+    parser.add_argument('--tile-overlap', type=int, default=0, help='Voxels shared by neighbour tiles.')
+    parser.add_argument('--probabilities', choices=PROBABILITY_FORMATS, default=None,
+                        help='Also write the class probabilities, in this format, to the file given by the '
+                             '"probabilities" key of each manifest entry.')
+    args = parser.parse_args()
+
+    addDeepFinderToPath(args.df_home)
+    seg = getSegmenter(getWorkerCache(globals()), args.weights, args.nclasses, args.psize)
+
+    done = set(readProgress(args.progress))
+    for entry in readManifest(args.manifest):
+        tsId = entry['tsId']
+        if tsId in done:
+            continue
+        print('Segmenting %s...' % tsId, flush=True)
+        outputFiles = [entry['output']]
+        if args.probabilities:
+            outputFiles.append(entry['probabilities'])
+        tmpFiles = [getTmpFileName(outputFile) for outputFile in outputFiles]
+        tmpOutputFile = tmpFiles[0]
+        tmpProbabilitiesFile = tmpFiles[1] if args.probabilities else None
+        if args.tile_size > 0:
+            segmentTomogramTiled(seg, entry['tomo'], tmpOutputFile, args.tile_size, args.tile_overlap,
+                                 tmpProbabilitiesFile, args.probabilities)
+        else:
+            segmentTomogram(seg, entry['tomo'], tmpOutputFile, tmpProbabilitiesFile, args.probabilities)
+        for tmpFile, outputFile in zip(tmpFiles, outputFiles):
+            os.replace(tmpFile, outputFile)
+        appendProgress(args.progress, tsId)
+
+
+if __name__ == '__main__':
+    main()
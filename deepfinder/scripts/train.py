@@ -0,0 +1,331 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+DeepFinder training driven by precomputed sampling indices (see deepfinder/processing/sampling.py). It trains the same
+network, with the same loss, patch extraction, normalization and augmentation than DeepFinder's train program, but the
+patches are drawn in constant time from the indices instead of being searched for in the object lists at every batch.
+The validation patches are drawn once, with a fixed seed, and kept in memory for all the epochs. The training history,
+its plot and the weights are written with the same names than DeepFinder does.
+
+The training can start from the weights of an existing model (fine-tuning), and a checkpoint (weights, epoch counter
+and history) is written at the end of each epoch, so an interrupted training can be resumed where it stopped.
+
+Only some of the weights of the intermediate epochs are kept (see CheckpointRetention): the best ones by validation
+loss and the ones of every k-th epoch. They are listed, ranked by validation loss, in a manifest file.
+
+The metrics of each epoch are appended, as a JSON line, to a metrics file, so the training can be followed while it
+runs.
+"""
+import argparse
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from script_utils import addDeepFinderToPath, mmapVolume, CHECKPOINTS_MANIFEST, TRAINING_METRICS_FILE
+
+DATASET_NAME = 'dataset'
+VALIDATION_SEED = 0
+SAVE_PERIOD = 10  # epochs
+CHECKPOINT_WEIGHTS = 'checkpoint_weights.h5'
+CHECKPOINT_STATE = 'checkpoint_state.json'
+
+
+def readTrainParams(paramsFile):
+    """ Parameters written by the train protocol (same format than DeepFinder's ParamsTrain). """
+    root = ET.parse(paramsFile).getroot()
+    return {'path_out': root.find('path_out').get('path'),
+            'path_tomo': [elem.get('path') for elem in root.find('path_tomo')],
+            'path_target': [elem.get('path') for elem in root.find('path_target')],
+            'Ncl': int(root.find('number_of_classes').get('n')),
+            'psize': int(root.find('patch_size').get('n')),
+            'bsize': int(root.find('batch_size').get('n')),
+            'nepochs': int(root.find('number_of_epochs').get('n')),
+            'steps_per_e': int(root.find('steps_per_epoch').get('n')),
+            'steps_per_v': int(root.find('steps_per_validation').get('n')),
+            'flag_direct_read': root.find('flag_direct_read').get('flag') == 'True',
+            'flag_bootstrap': root.find('flag_bootstrap').get('flag') == 'True'}
+
+
+def openVolume(filename, directRead):
+    """ Data of a tomogram or a target, indexed as (z, y, x). With direct read, the patches are read from disk when
+    they are needed, otherwise the whole volume is loaded in memory. """
+    if filename.endswith('.h5'):
+        import h5py
+        data = h5py.File(filename, 'r')[DATASET_NAME]
+    else:
+        data = mmapVolume(filename)
+    return data if directRead else np.array(data)
+
+
+class PatchSampler:
+    """ Draws patch positions from a sampling index. With bootstrap, a class is chosen first (all of them are equally
+    likely) and then one of its objects, otherwise all the objects are equally likely. """
+
+    def __init__(self, indexFile, psize, bootstrap, randomState):
+        index = np.load(indexFile)
+        self.tomoIdx = index['tomo_idx']
+        self.position = index['position']
+        self.rndShift = int(index['rnd_shift'])
+        self.low = index['low_%d' % psize]
+        self.high = index['high_%d' % psize]
+        self.classStarts = index['class_starts']
+        self.classOrder = index['class_order']
+        self.bootstrap = bootstrap
+        self.random = randomState
+
+    def __len__(self):
+        return len(self.tomoIdx)
+
+    def draw(self, n):
+        """ tomo_idx and patch center, as (z, y, x), of n patches. """
+        if self.bootstrap:
+            cls = self.random.randint(len(self.classStarts) - 1, size=n)
+            starts = self.classStarts[cls]
+            counts = self.classStarts[cls + 1] - starts
+            objs = self.classOrder[starts + (self.random.random_sample(n) * counts).astype(np.int64)]
+        else:
+            objs = self.random.randint(len(self), size=n)
+        shifts = self.random.randint(-self.rndShift, self.rndShift + 1, size=(n, 3))
+        centers = np.clip(self.position[objs] + shifts, self.low[objs], self.high[objs])
+        return self.tomoIdx[objs], centers
+
+
+def extractPatches(tomos, targets, tomoIdx, centers, psize):
+    """ Normalized tomogram patches, as (n, psize, psize, psize, 1) float32, and their labels, as uint8. The flat
+    patches (e.g. outside the reconstructed area) are all zeros. """
+    half = psize // 2
+    data = np.zeros((len(tomoIdx), psize, psize, psize, 1), dtype=np.float32)
+    labels = np.zeros((len(tomoIdx), psize, psize, psize), dtype=np.uint8)
+    for i, (idx, (z, y, x)) in enumerate(zip(tomoIdx, centers)):
+        box = (slice(z - half, z + half), slice(y - half, y + half), slice(x - half, x + half))
+        patch = np.asarray(tomos[idx][box], dtype=np.float32)
+        if patch.shape != (psize, psize, psize):
+            raise ValueError('Tomogram %d is smaller than the patch size (%d).' % (idx, psize))
+        patch = patch - np.mean(patch)
+        std = np.std(patch)
+        data[i, ..., 0] = patch / std if std > 0 else patch
+        labels[i] = targets[idx][box]
+    return data, labels
+
+
+def toCategorical(labels, Ncl):
+    return np.eye(Ncl, dtype=np.float32)[labels]
+
+
+def augment(data, labels, randomState):
+    """ DeepFinder's data augmentation: 180 degrees rotation around the tilt axis of half of the patches. """
+    for i in np.nonzero(randomState.random_sample(len(data)) < 0.5)[0]:
+        data[i] = np.rot90(data[i], k=2, axes=(0, 2))
+        labels[i] = np.rot90(labels[i], k=2, axes=(0, 2))
+
+
+def readCheckpoint(pathOut):
+    """ State of the last checkpoint written in the given folder, or None if there is not any. """
+    stateFile = os.path.join(pathOut, CHECKPOINT_STATE)
+    if not os.path.exists(stateFile):
+        return None
+    with open(stateFile) as f:
+        return json.load(f)
+
+
+def writeCheckpoint(net, pathOut, state):
+    """ Save the weights and the training state. Both files are replaced atomically, the state being written last,
+    so a checkpoint is never read before it is complete. """
+    weightsFile = os.path.join(pathOut, CHECKPOINT_WEIGHTS)
+    tmpWeights = weightsFile + '.tmp.h5'
+    net.save_weights(tmpWeights)
+    os.replace(tmpWeights, weightsFile)
+    stateFile = os.path.join(pathOut, CHECKPOINT_STATE)
+    with open(stateFile + '.tmp', 'w') as f:
+        json.dump(state, f, default=lambda value: value.tolist())  # NumPy values
+    os.replace(stateFile + '.tmp', stateFile)
+
+
+class CheckpointRetention:
+    """ Decides which epoch weights are kept: the keepBest ones with the lowest validation loss, the ones of every
+    keepEvery-th epoch and the final ones. The rest are deleted as soon as they are out of the best ones, so the disk
+    use does not grow with the number of epochs. """
+
+    def __init__(self, pathOut, keepBest, keepEvery):
+        self.pathOut = pathOut
+        self.keepBest = keepBest
+        self.keepEvery = keepEvery
+        self.manifestFile = os.path.join(pathOut, CHECKPOINTS_MANIFEST)
+        self.entries = {}  # epoch: entry, final weights excluded
+        if os.path.exists(self.manifestFile):  # Resumed training
+            with open(self.manifestFile) as f:
+                self.entries = {entry['epoch']: entry for entry in json.load(f) if not entry['final']}
+
+    def _bestEpochs(self):
+        return set(sorted(self.entries, key=lambda epoch: self.entries[epoch]['val_loss'])[:self.keepBest])
+
+    def update(self, net, epoch, valLoss):
+        """ Save the weights of the given epoch if they have to be kept, and delete the ones not kept anymore. """
+        periodic = self.keepEvery > 0 and epoch % self.keepEvery == 0
+        bestLosses = sorted(self.entries[e]['val_loss'] for e in self._bestEpochs())
+        isBest = self.keepBest > 0 and (len(bestLosses) < self.keepBest or valLoss < bestLosses[-1])
+        if not periodic and not isBest:
+            return
+        fileName = 'net_weights_epoch%d.h5' % epoch
+        net.save(os.path.join(self.pathOut, fileName))
+        self.entries[epoch] = {'epoch': epoch, 'file': fileName, 'val_loss': float(valLoss), 'periodic': periodic,
+                               'final': False}
+        bestEpochs = self._bestEpochs()
+        for e in list(self.entries):
+            if e not in bestEpochs and not self.entries[e]['periodic']:
+                os.remove(os.path.join(self.pathOut, self.entries.pop(e)['file']))
+        self.writeManifest()
+
+    def writeManifest(self, final=None):
+        """ Write the kept weights, best validation loss first. """
+        bestEpochs = self._bestEpochs()
+        entries = [dict(entry, best=epoch in bestEpochs) for epoch, entry in self.entries.items()]
+        if final:
+            entries.append(final)
+        entries.sort(key=lambda entry: entry['val_loss'])
+        with open(self.manifestFile + '.tmp', 'w') as f:
+            json.dump(entries, f, indent=2)
+        os.replace(self.manifestFile + '.tmp', self.manifestFile)
+
+
+def appendMetrics(pathOut, record):
+    with open(os.path.join(pathOut, TRAINING_METRICS_FILE), 'a') as f:
+        f.write(json.dumps(record, default=lambda value: value.tolist()) + '\n')  # NumPy values
+        f.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train a DeepFinder model from precomputed sampling indices.')
+    parser.add_argument('--df-home', required=True, help='DeepFinder installation folder.')
+    parser.add_argument('-p', '--params', required=True, help='Training parameters file.')
+    parser.add_argument('--train-index', required=True, help='Sampling index of the training objects.')
+    parser.add_argument('--valid-index', required=True, help='Sampling index of the validation objects.')
+    parser.add_argument('--init-weights', default=None, help='Weights the training starts from (fine-tuning).')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the training from the checkpoint of the output folder, if any.')
+    parser.add_argument('--keep-best', type=int, default=0,
+                        help='Number of epoch weights kept by lowest validation loss.')
+    parser.add_argument('--keep-every', type=int, default=SAVE_PERIOD,
+                        help='The weights of every k-th epoch are kept (0 for none).')
+    args = parser.parse_args()
+
+    addDeepFinderToPath(args.df_home)
+    from sklearn.metrics import precision_recall_fscore_support
+    from deepfinder.training import Train
+    from deepfinder.utils import core
+
+    params = readTrainParams(args.params)
+    Ncl, psize, bsize = params['Ncl'], params['psize'], params['bsize']
+    pathOut = params['path_out']
+    trainer = Train(Ncl=Ncl, dim_in=psize)
+    net = trainer.net
+    net.compile(optimizer=trainer.optimizer, loss=trainer.loss, metrics=['accuracy'])
+
+    tomos = [openVolume(fn, params['flag_direct_read']) for fn in params['path_tomo']]
+    targets = [openVolume(fn, params['flag_direct_read']) for fn in params['path_target']]
+    trainSampler = PatchSampler(args.train_index, psize, params['flag_bootstrap'], np.random.RandomState())
+    validSampler = PatchSampler(args.valid_index, psize, params['flag_bootstrap'],
+                                np.random.RandomState(VALIDATION_SEED))
+    validData, validLabels = extractPatches(tomos, targets, *validSampler.draw(params['steps_per_v'] * bsize),
+                                            psize=psize)
+
+    history = {'acc': [], 'loss': [], 'val_acc': [], 'val_loss': [], 'val_f1': [], 'val_recall': [],
+               'val_precision': []}
+    processTime = []
+    firstEpoch = 0
+    checkpoint = readCheckpoint(pathOut) if args.resume else None
+    if checkpoint:
+        net.load_weights(os.path.join(pathOut, CHECKPOINT_WEIGHTS))
+        firstEpoch, history, processTime = checkpoint['epoch'], checkpoint['history'], checkpoint['process_time']
+        print('Resuming training from epoch %d' % (firstEpoch + 1), flush=True)
+    elif args.init_weights:
+        net.load_weights(args.init_weights)
+        print('Training initialized with the weights of %s' % args.init_weights, flush=True)
+
+    retention = CheckpointRetention(pathOut, args.keep_best, args.keep_every)
+    nEpochs = params['nepochs']
+    for epoch in range(firstEpoch, nEpochs):
+        start = time.time()
+        lossTrain, accTrain = [], []
+        for it in range(params['steps_per_e']):
+            data, labels = extractPatches(tomos, targets, *trainSampler.draw(bsize), psize=psize)
+            augment(data, labels, trainSampler.random)
+            loss, acc = net.train_on_batch(data, toCategorical(labels, Ncl))[:2]
+            print('epoch %d/%d - it %d/%d - loss: %0.3f - acc: %0.3f' %
+                  (epoch + 1, nEpochs, it + 1, params['steps_per_e'], loss, acc), flush=True)
+            lossTrain.append(loss)
+            accTrain.append(acc)
+        history['loss'].append(lossTrain)
+        history['acc'].append(accTrain)
+        trainTime = time.time() - start
+
+        lossValid, accValid, f1, recall, precision = [], [], [], [], []
+        for b in range(0, len(validData), bsize):
+            data, labels = validData[b:b + bsize], validLabels[b:b + bsize]
+            loss, acc = net.evaluate(data, toCategorical(labels, Ncl), verbose=0)[:2]
+            pred = net.predict(data)
+            scores = precision_recall_fscore_support(labels.flatten(), pred.argmax(axis=-1).flatten(),
+                                                     average=None, labels=range(Ncl))
+            lossValid.append(loss)
+            accValid.append(acc)
+            precision.append(scores[0])
+            recall.append(scores[1])
+            f1.append(scores[2])
+        history['val_loss'].append(lossValid)
+        history['val_acc'].append(accValid)
+        history['val_f1'].append(f1)
+        history['val_recall'].append(recall)
+        history['val_precision'].append(precision)
+        processTime.append(time.time() - start)
+        print('EPOCH %d/%d - valid loss: %0.3f - valid acc: %0.3f - %0.2fsec' %
+              (epoch + 1, nEpochs, np.mean(lossValid), np.mean(accValid), processTime[-1]), flush=True)
+        core.save_history(history, pathOut + 'net_train_history.h5')
+        core.plot_history(history, pathOut + 'net_train_history_plot.png')
+        retention.update(net, epoch + 1, np.mean(lossValid))
+        writeCheckpoint(net, pathOut, {'epoch': epoch + 1, 'history': history, 'process_time': processTime})
+        appendMetrics(pathOut, {'epoch': epoch + 1,
+                                'loss': np.mean(lossTrain),
+                                'acc': np.mean(accTrain),
+                                'val_loss': np.mean(lossValid),
+                                'val_acc': np.mean(accValid),
+                                'val_f1': np.mean(f1, axis=0),
+                                'val_precision': np.mean(precision, axis=0),
+                                'val_recall': np.mean(recall, axis=0),
+                                'epoch_time': processTime[-1],
+                                'samples_per_s': params['steps_per_e'] * bsize / trainTime})
+
+    print('Model took %0.2f seconds to train' % np.sum(processTime), flush=True)
+    net.save(pathOut + 'net_weights_FINAL.h5')
+    finalLoss = np.mean(history['val_loss'][-1]) if history['val_loss'] else np.inf
+    retention.writeManifest(final={'epoch': nEpochs, 'file': 'net_weights_FINAL.h5', 'val_loss': float(finalLoss),
+                                   'periodic': False, 'final': True, 'best': False})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Long-lived DeepFinder worker. It runs inside the DeepFinder environment and executes the scripts of this plugin
+(e.g. segment_batch) in-process, one job at a time, so the environment activation, the Python start-up and the
+TensorFlow/Keras imports are paid only once per worker instead of once per step. The scripts can also keep objects
+between jobs, like the loaded networks, in the worker cache (see script_utils.getWorkerCache). The DeepFinder programs
+do not use that cache, so the plugin does not send them to the worker.
+
+Jobs are received through a local socket (multiprocessing.connection) as dicts:
+    {'program': path to the program, 'args': list of arguments, 'cwd': working directory or None}
+and answered with {'status': exit code, 'error': traceback or None}. A {'stop': True} message ends the worker.
+The worker also exits if the process that launched it (the protocol) disappears.
+"""
+import argparse
+import json
+import os
+import runpy
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Listener
+
+AUTHKEY_VAR = 'DF_WORKER_AUTHKEY'
+PARENT_CHECK_PERIOD = 5  # seconds
+
+# Objects that the programs may keep between jobs (e.g. loaded models). It is available for them as the global
+# variable DF_WORKER_CACHE.
+WORKER_CACHE = {}
+
+
+def preloadModules():
+    """ Import the heavy modules once, so the jobs find them already loaded. """
+    for module in ['numpy', 'tensorflow', 'keras']:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+
+def watchParent(parentPid):
+    while True:
+        try:
+            os.kill(parentPid, 0)
+        except OSError:
+            print('DeepFinder worker: parent process %d not found. Exiting.' % parentPid, flush=True)
+            os._exit(1)
+        time.sleep(PARENT_CHECK_PERIOD)
+
+
+def runJob(job):
+    program = job['program']
+    args = job.get('args', [])
+    cwd = job.get('cwd', None)
+    oldArgv, oldCwd = sys.argv, os.getcwd()
+    sys.argv = [program] + list(args)
+    status, error = 0, None
+    try:
+        if cwd:
+            os.chdir(cwd)
+        runpy.run_path(program, init_globals={'DF_WORKER_CACHE': WORKER_CACHE}, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            status = e.code if isinstance(e.code, int) else 1
+            error = str(e.code)
+    except BaseException:
+        status = 1
+        error = traceback.format_exc()
+        print(error, file=sys.stderr, flush=True)
+    finally:
+        sys.argv = oldArgv
+        os.chdir(oldCwd)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return {'status': status, 'error': error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Persistent DeepFinder worker.')
+    parser.add_argument('--address-file', required=True,
+                        help='File where the address of the worker is written once it is ready.')
+    parser.add_argument('--parent-pid', type=int, default=None,
+                        help='The worker exits when this process does not exist anymore.')
+    parser.add_argument('--preload', action='store_true', help='Import TensorFlow and Keras at start-up.')
+    args = parser.parse_args()
+
+    if args.preload:
+        preloadModules()
+    if args.parent_pid:
+        threading.Thread(target=watchParent, args=(args.parent_pid,), daemon=True).start()
+
+    authkey = bytes.fromhex(os.environ.pop(AUTHKEY_VAR))
+    listener = Listener(('localhost', 0), authkey=authkey)
+    # Write the address atomically, the client polls for this file
+    tmpFile = args.address_file + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump({'host': listener.address[0], 'port': listener.address[1], 'pid': os.getpid()}, f)
+    os.rename(tmpFile, args.address_file)
+    print('DeepFinder worker listening on %s:%d' % listener.address, flush=True)
+
+    while True:
+        with listener.accept() as conn:
+            job = conn.recv()
+            if job.get('stop', False):
+                conn.send({'status': 0, 'error': None})
+                break
+            conn.send(runJob(job))
+    listener.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -24,16 +24,383 @@
 # *  e-mail address 'you@yourinstitution.email'
 # *
 # **************************************************************************
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import tracemalloc
+import xml.etree.ElementTree as ET
 from os.path import exists
-from pyworkflow.tests import BaseTest, setupTestProject
+import numpy as np
+from scipy import ndimage
+from pyworkflow.tests import BaseTest, setupTestProject, setupTestOutput
 import tomo.protocols
 import pwem.protocols
 from tomo.protocols.protocol_import_tomograms import OUTPUT_NAME
 from . import DataSet
+import deepfinder.convert as cv
+from deepfinder.gpu_scheduler import GpuScheduler
+from deepfinder.scripts import SCRIPTS_DIR
+from deepfinder.processing import createSphere, generateSphereTargets, clusterMeanShift, clusterConnectedComponents, \
+    buildSamplingIndex, writeSamplingIndex, getSamplingIndexFile
+from deepfinder.constants import *
 from ..protocols import ImportCoordinates3D, DeepFinderGenerateTrainingTargetsSpheres, DeepFinderTrain, \
     ProtDeepFinderLoadTrainingModel, DeepFinderSegment, DeepFinderCluster
 
 
+class TestDeepFinderObjectLists(BaseTest):
+    """This class checks the reading and writing of DeepFinder object lists."""
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    @staticmethod
+    def _genObjectList(nObjects=1000):
+        objl = cv.ObjectList()
+        for idx in range(nObjects):
+            orient = (10.5, 20.25, -30.125) if idx % 7 == 0 else (None, None, None)
+            cv.objl_add(objl, label=idx % 3 + 1, coord=[idx * 0.5, idx * 0.25, idx * 0.125], tomo_idx=idx % 2,
+                        orient=orient, cluster_size=idx if idx % 5 else None)
+        return objl
+
+    @staticmethod
+    def _writeWithElementTree(objl, filename):
+        """Reference writer, as the object lists are written by DeepFinder."""
+        objl_xml = ET.Element('objlist')
+        for iobjl in objl:
+            obj = ET.SubElement(objl_xml, 'object')
+            for field, fmt in [(DF_TOMO_IDX, '%d'), (DF_OBJ_ID, '%d'), (DF_LABEL, '%d'), (DF_COORD_X, '%.3f'),
+                               (DF_COORD_Y, '%.3f'), (DF_COORD_Z, '%.3f'), (DF_PSI, '%.3f'), (DF_PHI, '%.3f'),
+                               (DF_THETA, '%.3f'), (DF_SCORE, '%d')]:
+                if iobjl[field] is not None:
+                    obj.set(field, fmt % iobjl[field])
+        ET.ElementTree(objl_xml).write(filename)
+
+    def test_object_list(self):
+        objl = self._genObjectList()
+        self.assertEqual(len(objl), 1000)
+        self.assertEqual(objl.get_labels(), [1, 2, 3])
+        self.assertEqual(objl.counts_by_label(), {1: 334, 2: 333, 3: 333})
+        self.assertEqual(len(cv.objl_get_class(objl, '2')), 333)
+        self.assertEqual(objl[7][DF_PSI], 10.5)
+        self.assertIsNone(objl[8][DF_PSI])
+        self.assertIsNone(objl[5][DF_SCORE])
+        # Compatibility with the list of dicts
+        self.assertEqual(cv.ObjectList.from_dicts(objl.to_dicts()).to_dicts(), objl.to_dicts())
+        self.assertEqual(len(cv.ObjectList.concatenate([objl, objl.get_class(1)])), 1334)
+
+    def test_xml_object_list(self):
+        objl = self._genObjectList()
+        fname = self.getOutputPath('objl.xml')
+        fnameRef = self.getOutputPath('objl_ref.xml')
+        cv.objl_write(objl, fname)
+        self._writeWithElementTree(objl, fnameRef)
+        with open(fname, 'rb') as f, open(fnameRef, 'rb') as fRef:
+            self.assertEqual(f.read(), fRef.read())
+
+        objlRead = cv.objl_read(fname)
+        self.assertEqual(len(objlRead), len(objl))
+        self.assertEqual(objlRead.counts_by_label(), objl.counts_by_label())
+        self.assertTrue(np.allclose(objlRead.positions(), objl.positions(), atol=1e-3))
+        self.assertEqual([len(chunk) for chunk in cv.objl_iter_chunks(fname, chunk_size=400)], [400, 400, 200])
+        self.assertEqual(cv.objl_count(fname), 1000)
+        # The count is updated when the file changes
+        cv.objl_write(objl[:10], fname)
+        self.assertEqual(cv.objl_count(fname), 10)
+
+    def test_binary_object_list(self):
+        objl = self._genObjectList()
+        fname = self.getOutputPath('objl' + cv.OBJL_BINARY_EXT)
+        cv.objl_write(objl, fname)
+        self.assertTrue(cv.objl_is_binary(fname))
+        objlRead = cv.objl_read(fname)
+        self.assertEqual(objlRead.to_dicts(), objl.to_dicts())
+        self.assertEqual(sum(len(chunk) for chunk in cv.objl_iter_chunks(fname, chunk_size=300)), 1000)
+        self.assertEqual(cv.objl_count(fname), 1000)
+
+
+class TestDeepFinderVolumes(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_volumes(self):
+        fname = self.getOutputPath('volume.mrc')
+        vol = cv.createVolume(fname, (10, 20, 30), dtype=np.float32, voxelSize=4.5)
+        vol[:] = np.arange(vol.size, dtype=np.float32).reshape(vol.shape)
+        vol.flush()
+        del vol
+
+        info = cv.getVolumeInfo(fname)
+        self.assertEqual(info.dims, (30, 20, 10))
+        self.assertEqual(info.voxelSize, (4.5, 4.5, 4.5))
+        self.assertEqual(info.dtype, np.float32)
+
+        vol = cv.mmapVolume(fname)
+        self.assertIsInstance(vol, np.memmap)
+        self.assertEqual(vol[3, 4, 5], 3 * 600 + 4 * 30 + 5)
+        box = cv.subVolume(vol, (8, -2, 25), (5, 5, 10))
+        self.assertEqual(box.shape, (2, 3, 5))
+        self.assertTrue(np.shares_memory(box, vol))
+        self.assertTrue(np.array_equal(box, vol[8:, :3, 25:]))
+
+    def test_cache(self):
+        cacheDir = self.getOutputPath('cache')
+        fnames = [self.getOutputPath('cache_%s.bin' % name) for name in 'abc']
+        for fname, content in zip(fnames, [b'tomo', b'tomo', b'target']):
+            with open(fname, 'wb') as f:
+                f.write(content)
+
+        cachedFiles = cv.getCachedFiles(cacheDir, fnames, '.h5')
+        self.assertEqual(cachedFiles[0], cachedFiles[1])  # Same content, same cached file
+        self.assertNotEqual(cachedFiles[0], cachedFiles[2])
+        self.assertEqual(os.path.dirname(cachedFiles[0]), cacheDir)
+        self.assertEqual(cv.getCachedHashes(cacheDir, fnames[:1]), [cv.fileHash(fnames[0])])
+
+        with open(fnames[0], 'wb') as f:
+            f.write(b'modified tomo')
+        self.assertNotEqual(cv.getCachedHashes(cacheDir, fnames[:1]), [cv.fileHash(fnames[1])])
+
+        linkedFile = os.path.join(cacheDir, 'linked.bin')
+        cv.linkOrCopy(fnames[2], linkedFile)
+        with open(linkedFile, 'rb') as f:
+            self.assertEqual(f.read(), b'target')
+
+    def test_metrics_stream(self):
+        fname = self.getOutputPath(cv.TRAINING_METRICS_FILE)
+        stream = cv.MetricsStream(fname)
+        self.assertEqual(stream.read(), [])
+        with open(fname, 'w') as f:
+            f.write('{"epoch": 1, "loss": 0.5}\n{"epoch": 2, ')  # Second record not completely written yet
+        self.assertEqual(stream.read(), [{'epoch': 1, 'loss': 0.5}])
+        with open(fname, 'a') as f:
+            f.write('"loss": 0.4}\n')
+        self.assertEqual(stream.read(), [{'epoch': 2, 'loss': 0.4}])
+        self.assertEqual(stream.read(), [])
+
+
+class TestDeepFinderGpuScheduler(BaseTest):
+
+    def test_gpu_scheduler(self):
+        gpuIds = [0, 1, 2]
+        jobsPerGpu = 2
+        nJobs = 20
+        scheduler = GpuScheduler(gpuIds, jobsPerGpu=jobsPerGpu)
+        self.assertEqual(scheduler.getNumberOfSlots(), 6)
+        lock = threading.Lock()
+        maxRunning = {gpuId: 0 for gpuId in gpuIds}
+        usedGpus = []
+
+        def job():
+            with scheduler.device() as gpuId:
+                with lock:
+                    running = scheduler.getRunningJobs()
+                    maxRunning[gpuId] = max(maxRunning[gpuId], running[gpuId])
+                    usedGpus.append(gpuId)
+                # Stub job that only reports the device it can see
+                out = subprocess.check_output('CUDA_VISIBLE_DEVICES=%s sh -c \'echo $CUDA_VISIBLE_DEVICES; '
+                                              'sleep 0.2\'' % gpuId, shell=True)
+                self.assertEqual(out.decode().strip(), str(gpuId))
+
+        threads = [threading.Thread(target=job) for _ in range(nJobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(usedGpus), nJobs)
+        self.assertEqual(set(usedGpus), set(gpuIds))
+        self.assertTrue(all(nRunning <= jobsPerGpu for nRunning in maxRunning.values()))
+        self.assertEqual(scheduler.getRunningJobs(), {gpuId: 0 for gpuId in gpuIds})
+        with self.assertRaises(ValueError):
+            scheduler.release(0)
+
+
+class TestDeepFinderSphereTargets(BaseTest):
+
+    @staticmethod
+    def _dfSphereTargets(objl, tomoShape, radiusList):
+        """ Same algorithm used by DeepFinder's generate_target (spheres strategy), voxel by voxel. """
+        target = np.zeros(tomoShape, dtype=np.int8)
+        dim = 2 * max(radiusList)
+        refs = [createSphere(dim, radius) for radius in radiusList]
+        for obj in objl:
+            lbl = obj[DF_LABEL]
+            x, y, z = int(obj[DF_COORD_X]), int(obj[DF_COORD_Y]), int(obj[DF_COORD_Z])
+            ref = refs[lbl - 1]
+            centerOffset = ref.shape[0] // 2
+            zVox, yVox, xVox = np.nonzero(ref == 1)
+            for zz, yy, xx in zip(zVox + z - centerOffset, yVox + y - centerOffset, xVox + x - centerOffset):
+                if 0 <= xx < tomoShape[2] and 0 <= yy < tomoShape[1] and 0 <= zz < tomoShape[0]:
+                    target[zz, yy, xx] = lbl
+        return target
+
+    def test_sphere_targets(self):
+        tomoShape = (40, 50, 60)
+        radiusList = [3, 6]
+        objl = cv.ObjectList()
+        # Inside the tomogram, overlapping and partially outside (including negative coordinates)
+        for lbl, (z, y, x) in [(1, (20, 25, 30)), (2, (22, 27, 33.7)), (2, (1, 2, 59)), (1, (39, 49.9, 0)),
+                               (2, (-3, 10, 10)), (1, (38, 0, 58))]:
+            cv.objl_add(objl, lbl, (z, y, x))
+        target = generateSphereTargets(objl, tomoShape, radiusList)
+        self.assertEqual(target.dtype, np.int8)
+        self.assertTrue(np.array_equal(target, self._dfSphereTargets(objl, tomoShape, radiusList)))
+        with self.assertRaises(ValueError):
+            generateSphereTargets(cv.objl_add(cv.ObjectList(), 3, (0, 0, 0)), tomoShape, radiusList)
+
+
+class TestDeepFinderSamplingIndex(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_sampling_index(self):
+        objl = cv.ObjectList.from_arrays([1, 2, 2, 2], [5, 50, 90, 30], [5, 40, 95, 30], [2, 20, 30, 10],
+                                         tomo_idx=[0, 0, 1, 1])
+        index = buildSamplingIndex(objl, [(40, 100, 100), (70, 100, 100)], [40, 64], rndShift=13)
+        self.assertTrue(np.array_equal(index['class_labels'], [1, 2]))
+        self.assertTrue(np.array_equal(index['class_order'], [0, 1, 2, 3]))
+        self.assertTrue(np.array_equal(index['class_starts'], [0, 1, 4]))
+        # Patch centers as (z, y, x), kept at psize / 2 voxels from the borders
+        self.assertTrue(np.array_equal(index['low_40'], [[20, 20, 20], [20, 27, 37], [20, 80, 77], [20, 20, 20]]))
+        self.assertTrue(np.array_equal(index['high_40'], [[20, 20, 20], [20, 53, 63], [43, 80, 80], [23, 43, 43]]))
+        self.assertTrue(np.array_equal(index['low_64'][3], [32, 32, 32]))
+
+    def test_patch_sampler(self):
+        # The scripts import their helpers by plain name, as they are executed from their folder
+        sys.path.insert(0, SCRIPTS_DIR)
+        try:
+            from train import PatchSampler, extractPatches
+        finally:
+            sys.path.remove(SCRIPTS_DIR)
+        tomoShape, psize, rndShift = (60, 80, 100), 10, 3
+        # One object of class 1 (next to the borders, so its patches are moved inside) and three of class 2
+        objl = cv.ObjectList.from_arrays([1, 2, 2, 2], [99, 30, 60, 80], [2, 30, 40, 20], [2, 30, 30, 40],
+                                         tomo_idx=[0, 0, 0, 0])
+        indexFile = getSamplingIndexFile(self.getOutputPath('objl.xml'))
+        writeSamplingIndex(objl, [tomoShape], [psize], rndShift, indexFile)
+        index = np.load(indexFile)
+        positions, low, high = index['position'], index['low_%d' % psize], index['high_%d' % psize]
+        labels = np.array([1, 2, 2, 2])
+
+        nDraws = 4000
+        for bootstrap, expectedFraction in [(True, 1 / 2), (False, 1 / 4)]:
+            sampler = PatchSampler(indexFile, psize, bootstrap, np.random.RandomState(0))
+            tomoIdx, centers = sampler.draw(nDraws)
+            self.assertEqual(centers.shape, (nDraws, 3))
+            self.assertTrue(np.all(tomoIdx == 0))
+            # The whole patch is inside the tomogram
+            self.assertTrue(np.all(centers >= psize // 2))
+            self.assertTrue(np.all(centers <= np.array(tomoShape) - psize // 2))
+            # Each center is in the range of the nearest object (they are far apart)
+            dist = np.abs(centers[:, None, :] - positions[None, :, :]).max(axis=2)
+            objs = np.argmin(dist, axis=1)
+            self.assertTrue(np.all((centers >= low[objs]) & (centers <= high[objs])))
+            self.assertTrue(np.all(centers[objs == 0] == [5, 5, 95]))
+            # The shifts cover the whole range
+            shifts = centers[objs != 0] - positions[objs[objs != 0]]
+            self.assertEqual((shifts.min(), shifts.max()), (-rndShift, rndShift))
+            # With bootstrap, both classes are drawn equally often, otherwise all the objects are
+            self.assertAlmostEqual(np.mean(labels[objs] == 1), expectedFraction, delta=0.03)
+
+        # Flat patches are not normalized (their std is 0)
+        tomo = np.ones(tomoShape, dtype=np.float32)
+        target = np.zeros(tomoShape, dtype=np.int8)
+        data, _ = extractPatches([tomo], [target], [0], [(30, 40, 50)], psize)
+        self.assertEqual(data.shape, (1, psize, psize, psize, 1))
+        self.assertTrue(np.all(data == 0))
+
+
+class TestDeepFinderTiledSegmentation(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    class _VoxelwiseNet:
+        """ Stand-in for the DeepFinder network whose scores of each voxel depend only on its value, so the blending
+        of the tiles must give the same scores than the whole volume. """
+        nClasses = 8
+
+        @classmethod
+        def scores(cls, values):
+            logits = np.stack([np.sin(values * (cls_ + 1)) for cls_ in range(cls.nClasses)], axis=-1)
+            expLogits = np.exp(logits)
+            return expLogits / expLogits.sum(axis=-1, keepdims=True)
+
+        def predict(self, patches, batch_size=1):
+            return self.scores(patches[..., 0])
+
+    class _Segment:
+        P, pcrop, poverlap = 16, 2, 4
+
+        def __init__(self, net):
+            self.net = net
+            self.Ncl = net.nClasses
+
+    def test_segment_tiled(self):
+        # The scripts import their helpers by plain name, as they are executed from their folder
+        sys.path.insert(0, SCRIPTS_DIR)
+        try:
+            from segment_batch import segmentTomogramTiled
+        finally:
+            sys.path.remove(SCRIPTS_DIR)
+        tomo = np.random.RandomState(0).normal(size=(40, 90, 100)).astype(np.float32)
+        tomoFile = self.getOutputPath('tomo_tiled.mrc')
+        cv.createVolume(tomoFile, tomo.shape, dtype=np.float32)[:] = tomo
+        expected = self._VoxelwiseNet.scores((tomo - tomo.mean()) / tomo.std())
+        seg = self._Segment(self._VoxelwiseNet())
+        fullScoresSize = expected.size * 4
+
+        for overlap in [0, 6]:
+            outputFile = self.getOutputPath('segmentation_tiled_%d.mrc' % overlap)
+            probabilitiesFile = self.getOutputPath('segmentation_tiled_%d_probabilities.npy' % overlap)
+            tracemalloc.start()
+            try:
+                segmentTomogramTiled(seg, tomoFile, outputFile, 16, overlap, probabilitiesFile, 'float16')
+                _, peakMemory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            # Each voxel gets the scores of its value, whatever the tiles that cover it
+            probabilities = cv.decodeProbabilities(cv.mmapProbabilities(probabilitiesFile))
+            self.assertTrue(np.allclose(probabilities, expected, atol=1e-3))
+            labelmap = cv.mmapVolume(outputFile)
+            self.assertTrue(np.array_equal(labelmap, np.argmax(expected, axis=-1)))
+            # Only a few tiles of scores are kept in memory, and the scratch file has been removed
+            self.assertLess(peakMemory, fullScoresSize / 4)
+            self.assertFalse(exists(os.path.splitext(outputFile)[0] + '.scores.tmp'))
+
+
+class TestDeepFinderClustering(BaseTest):
+
+    def test_clustering(self):
+        tomoShape = (40, 60, 80)
+        # Separated objects of two classes, as (label, z, y, x)
+        objects = [(1, 10, 10, 10), (2, 10, 30, 60), (1, 30, 45, 20), (2, 25, 15, 40), (1, 30, 50, 70)]
+        objl = cv.ObjectList()
+        for lbl, z, y, x in objects:
+            cv.objl_add(objl, lbl, (z, y, x))
+        labelmap = generateSphereTargets(objl, tomoShape, [4, 6])
+        sphereSizes = {lbl: np.count_nonzero(createSphere(12, radius)) for lbl, radius in [(1, 4), (2, 6)]}
+
+        for clustObjl in [clusterMeanShift(labelmap, 6, workers=2), clusterConnectedComponents(labelmap)]:
+            self.assertEqual(len(clustObjl), len(objects))
+            for lbl, z, y, x in objects:
+                dist = np.linalg.norm(clustObjl.positions() - (x, y, z), axis=1)
+                ind = int(np.argmin(dist))
+                self.assertLess(dist[ind], 1)
+                self.assertEqual(clustObjl[ind][DF_LABEL], lbl)
+                self.assertEqual(clustObjl[ind][DF_SCORE], sphereSizes[lbl])
+
+        self.assertEqual(len(clusterMeanShift(np.zeros(tomoShape, dtype=np.int8), 5)), 0)
+
+
 class TestDeepFinderImportCoordinates(BaseTest):
     """This class check if the protocol to import DeepFinder object lists works properly."""
 
@@ -229,6 +596,22 @@ class TestDeepFinderTrain(BaseTest):
                 self.assertTrue(output, "There was a problem with training output (net model weights)")
                 self.assertEqual(output.getNbOfClasses(), numClasses)
                 self.assertTrue(exists(output.getPath()))
+            # Only the retained weights are registered (the best epochs, every 10th epoch and the final ones), in
+            # ascending validation loss order
+            with open(protTrain._getExtraPath(CHECKPOINTS_MANIFEST)) as f:
+                checkpoints = json.load(f)
+            valLosses = [checkpoint['val_loss'] for checkpoint in checkpoints]
+            self.assertEqual(valLosses, sorted(valLosses))
+            outputs = [output.getPath() for _, output in protTrain.iterOutputAttributes()]
+            self.assertEqual(outputs, [os.path.abspath(protTrain._getExtraPath(checkpoint['file']))
+                                       for checkpoint in checkpoints])
+            epochCheckpoints = [checkpoint for checkpoint in checkpoints if not checkpoint['final']]
+            self.assertEqual(sum(checkpoint['best'] for checkpoint in epochCheckpoints), protTrain.keepBest.get())
+            self.assertTrue(all(checkpoint['best'] or checkpoint['periodic'] for checkpoint in epochCheckpoints))
+            # The weights of the rest of the epochs have been deleted
+            epochWeights = glob.glob(protTrain._getExtraPath('net_weights_epoch*.h5'))
+            self.assertEqual(sorted(os.path.basename(weights) for weights in epochWeights),
+                             sorted(checkpoint['file'] for checkpoint in epochCheckpoints))
 
 
 class TestDeepFinderSegment(BaseTest):
@@ -239,7 +622,7 @@ class TestDeepFinderSegment(BaseTest):
         setupTestProject(cls)
         cls.dataset = DataSet.getDataSet('deepfinder')
 
-    def _runDeepFinderSegment(self):
+    def _runDeepFinderSegment(self, **kwargs):
         # Get tomo:
         protImportTomogram = self.newProtocol(tomo.protocols.ProtImportTomograms,
                                               filesPath=self.dataset.getPath() + '/cropped_tomo0.mrc',
@@ -261,7 +644,8 @@ class TestDeepFinderSegment(BaseTest):
         protSegment = self.newProtocol(DeepFinderSegment,
                                        inputTomograms=protImportTomogram.Tomograms,
                                        weights=protImportModel.netWeights,
-                                       psize=80)
+                                       psize=80,
+                                       **kwargs)
         self.launchProtocol(protSegment)
 
         return protSegment
@@ -274,6 +658,55 @@ class TestDeepFinderSegment(BaseTest):
 
         return output
 
+    def test_segment_batch(self):
+        protSegment = self._runDeepFinderSegment(batchMode=True)
+        output = getattr(protSegment, protSegment._possibleOutputs.segmentations.name, None)
+
+        self.assertTrue(output, "There was a problem with segmentation output (SetOfTomoMasks)")
+        self.assertEqual(output.getSize(), 1)
+        for tomoMask in output:
+            self.assertTrue(exists(tomoMask.getFileName()))
+
+    def test_segment_tiled(self):
+        protSegment = self._runDeepFinderSegment(tiled=True, tileSize=96, tileOverlap=16)
+        output = getattr(protSegment, protSegment._possibleOutputs.segmentations.name, None)
+
+        self.assertTrue(output, "There was a problem with segmentation output (SetOfTomoMasks)")
+        self.assertEqual(output.getSize(), 1)
+        for tomoMask in output:
+            # The segmentation has the size of the tomogram
+            info = cv.getVolumeInfo(tomoMask.getFileName())
+            self.assertEqual(info.dims, tomoMask.getTomogram().getDimensions())
+        # The scratch score maps and the temporary outputs have been removed
+        self.assertEqual(glob.glob(protSegment._getExtraPath('*.tmp*')), [])
+
+    def test_segment_cache(self):
+        protSegment1 = self._runDeepFinderSegment(useCache=True)
+        protSegment2 = self._runDeepFinderSegment(useCache=True)
+        # The second run gets the segmentation from the cache
+        for protSegment in [protSegment1, protSegment2]:
+            output = getattr(protSegment, protSegment._possibleOutputs.segmentations.name, None)
+            self.assertTrue(output, "There was a problem with segmentation output (SetOfTomoMasks)")
+            self.assertEqual(output.getSize(), 1)
+        segm1 = protSegment1.segmentations.getFirstItem().getFileName()
+        segm2 = protSegment2.segmentations.getFirstItem().getFileName()
+        self.assertTrue(np.array_equal(cv.mmapVolume(segm1), cv.mmapVolume(segm2)))
+        self.assertFalse(exists(protSegment2._getProgressFile(protSegment2.segmentations.getFirstItem().getTsId())))
+
+    def test_segment_probabilities(self):
+        protSegment = self._runDeepFinderSegment(probabilities=DeepFinderSegment.UINT8_PROBABILITIES)
+        output = getattr(protSegment, protSegment._possibleOutputs.segmentations.name, None)
+
+        self.assertTrue(output, "There was a problem with segmentation output (SetOfTomoMasks)")
+        for tomoMask in output:
+            labelmap = cv.mmapVolume(tomoMask.getFileName())
+            self.assertEqual(labelmap.dtype, np.int8)
+            probabilities = cv.mmapProbabilities(cv.getProbabilitiesFile(tomoMask))
+            self.assertEqual(probabilities.dtype, np.uint8)
+            self.assertEqual(probabilities.shape[:3], labelmap.shape)
+            self.assertTrue(np.allclose(cv.decodeProbabilities(probabilities).sum(axis=-1), 1,
+                                        atol=probabilities.shape[-1] / 255))
+
 
 class TestDeepFinderCluster(BaseTest):
     """This class check if the protocol for analyzing/clustering segmentation maps works properly."""
@@ -283,7 +716,7 @@ class TestDeepFinderCluster(BaseTest):
         setupTestProject(cls)
         cls.dataset = DataSet.getDataSet('deepfinder')
 
-    def _runDeepFinderCluster(self):
+    def _runDeepFinderCluster(self, **kwargs):
         # Get TomoMask (with target generation protocol):
         # Get tomos:
         protImportTomogram = self.newProtocol(tomo.protocols.ProtImportTomograms,
@@ -315,7 +748,8 @@ class TestDeepFinderCluster(BaseTest):
         # Define and launch test protocol:
         protClust = self.newProtocol(DeepFinderCluster,
                                      inputSegmentations=output,
-                                     cradius=10)
+                                     cradius=10,
+                                     **kwargs)
         self.launchProtocol(protClust)
 
         return protClust
@@ -329,3 +763,13 @@ class TestDeepFinderCluster(BaseTest):
 
         return output
 
+    def test_cluster_connected_components(self):
+        protClust = self._runDeepFinderCluster(clusterMethod=DeepFinderCluster.CONNECTED_COMPONENTS)
+        output = getattr(protClust, protClust._possibleOutputs.coordinates.name, None)
+
+        self.assertTrue(output, "There was a problem with segmentation map analysis output (coordinates)")
+        # One object per connected region of each class of the target map (touching spheres are merged)
+        labelmap = cv.mmapVolume(protClust.inputSegmentations.get().getFirstItem().getFileName())
+        nRegions = sum(ndimage.label(labelmap == lbl)[1] for lbl in np.unique(labelmap) if lbl > 0)
+        self.assertEqual(output.getSize(), nRegions)
+
@@ -1,6 +1,8 @@
+from os.path import exists
 from matplotlib import pyplot as plt
 import pyworkflow.viewer as pwviewer
 from pwem.viewers import ImageView
+import deepfinder.convert as cv
 from deepfinder.protocols.protocol_train import DeepFinderTrain
 
 
@@ -9,7 +11,11 @@ class DeepFinderLCurvesViewer(pwviewer.Viewer):
     _targets = [DeepFinderTrain]
 
     def _visualize(self, obj, **kwargs):
-        view = DFImageView(self.protocol._getExtraPath('net_train_history_plot.png'))
+        metricsFile = self.protocol._getExtraPath(cv.TRAINING_METRICS_FILE)
+        if exists(metricsFile):
+            view = DFLearningCurvesView(metricsFile)
+        else:  # Trained with DeepFinder's program, only the final plot is available
+            view = DFImageView(self.protocol._getExtraPath('net_train_history_plot.png'))
         view._tkParent = self.getTkRoot()
         return [view]
 
@@ -24,3 +30,56 @@ class DFImageView(ImageView):
         plt.axis('off')
         plt.tight_layout()  # Decrease the padding
         plt.show()
+
+
+class DFLearningCurvesView(pwviewer.View):
+    """ Learning curves drawn from the metrics written by the training after each epoch. The metrics file is
+    followed while the window is open, so the curves of a running training are updated as new epochs end. """
+
+    REFRESH_PERIOD = 5000  # ms
+
+    def __init__(self, metricsFile):
+        self._stream = cv.MetricsStream(metricsFile)
+        self._records = {}  # epoch: metrics. The epochs repeated after resuming a training replace the old ones
+        self._fig = None
+        self._axes = None
+        self._timer = None
+
+    def show(self):
+        self._fig, self._axes = plt.subplots(1, 3, num='DeepFinder Learning Curves', figsize=(15, 4.5))
+        self._update()
+        # The timer has to be kept referenced, or it is garbage collected and stops
+        self._timer = self._fig.canvas.new_timer(interval=self.REFRESH_PERIOD)
+        self._timer.add_callback(self._update)
+        self._timer.start()
+        plt.show()
+
+    def _update(self):
+        records = self._stream.read()
+        if not records and self._records:
+            return
+        for record in records:
+            self._records[record['epoch']] = record
+        epochs = sorted(self._records)
+        metrics = [self._records[epoch] for epoch in epochs]
+        axLoss, axAcc, axF1 = self._axes
+
+        for ax, key, title in [(axLoss, 'loss', 'Loss'), (axAcc, 'acc', 'Accuracy')]:
+            ax.clear()
+            ax.plot(epochs, [m[key] for m in metrics], label='train')
+            ax.plot(epochs, [m['val_' + key] for m in metrics], label='validation')
+            ax.set_title(title)
+            ax.set_xlabel('Epoch')
+            ax.legend()
+
+        axF1.clear()
+        if metrics:
+            for label in range(len(metrics[0]['val_f1'])):
+                axF1.plot(epochs, [m['val_f1'][label] for m in metrics], label='class %i' % label)
+            axF1.legend()
+            last = metrics[-1]
+            self._fig.suptitle('Epoch %i - %0.1f s/epoch - %0.1f samples/s' %
+                               (last['epoch'], last['epoch_time'], last['samples_per_s']))
+        axF1.set_title('Validation F1-score')
+        axF1.set_xlabel('Epoch')
+        self._fig.canvas.draw_idle()
@@ -26,7 +26,7 @@
 # **************************************************************************
 from os.path import join, isfile, abspath
 
-from deepfinder.convert import objl_read
+from deepfinder.convert import objl_count
 from pyworkflow.utils import removeBaseExt
 from tomo.viewers.views_tkinter_tree import TomogramsTreeProvider
 
@@ -38,7 +38,7 @@ class ParticleAnnotatorProvider(TomogramsTreeProvider):
         filePath = join(self._path, "objl_annot_" + tomogramName + ".xml")
 
         if isfile(filePath):
-            nCoords = len(objl_read(abspath(filePath)))
+            nCoords = objl_count(abspath(filePath))
             return {'key': tomogramName, 'parent': None,
                     'text': tomogramName, 'values': (nCoords, 'DONE'),
                     'tags': "done"}
@@ -0,0 +1,125 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import logging
+import os
+import shlex
+import subprocess
+import threading
+import time
+from multiprocessing.connection import Client
+
+from pyworkflow.utils import cyanStr
+from deepfinder import Plugin
+from deepfinder.scripts import getScript
+from deepfinder.scripts.worker_server import AUTHKEY_VAR
+
+logger = logging.getLogger(__name__)
+
+
+class DeepFinderWorker:
+    """ Client of a long-lived process running in the DeepFinder environment (see scripts/worker_server.py). The
+    plugin scripts sent to it are executed in-process, so the environment activation and the TensorFlow imports are
+    done only once, and the scripts can keep their loaded models between jobs (see script_utils.getWorkerCache). The
+    jobs are executed one at a time, in the order they arrive: the protocols start one worker per concurrent job (see
+    ProtDeepFinderBase.deepFinderWorker).
+    """
+
+    START_TIMEOUT = 600  # seconds, TensorFlow import may be slow in some systems
+
+    def __init__(self, workingDir, cudaDevices=None, preload=True, name='main'):
+        self._workingDir = workingDir
+        self._cudaDevices = cudaDevices
+        self._preload = preload
+        self._addressFile = os.path.join(workingDir, 'df_worker_%s_address.json' % name)
+        self._authkey = os.urandom(16)
+        self._address = None
+        self._process = None
+        self._lock = threading.Lock()
+
+    def isRunning(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        if os.path.exists(self._addressFile):
+            os.remove(self._addressFile)
+
+        cmd = '%s %s && ' % (Plugin.getCondaActivationCmd(), Plugin.getDeepFinderEnvActivation())
+        if self._cudaDevices is not None:
+            cmd += 'CUDA_VISIBLE_DEVICES=%s ' % self._cudaDevices
+        # exec, so the worker replaces the shell and can be stopped directly
+        cmd += 'exec python %s --address-file %s --parent-pid %d' % (getScript('worker_server'),
+                                                                      self._addressFile, os.getpid())
+        if self._preload:
+            cmd += ' --preload'
+
+        env = Plugin.getEnviron()
+        env[AUTHKEY_VAR] = self._authkey.hex()
+        logger.info(cyanStr('Starting DeepFinder worker: %s' % cmd))
+        self._process = subprocess.Popen(cmd, shell=True, executable='/bin/bash', env=env)
+
+        startTime = time.time()
+        while not os.path.exists(self._addressFile):
+            if not self.isRunning():
+                raise Exception('DeepFinder worker could not be started (exit code %s).' % self._process.returncode)
+            if time.time() - startTime > self.START_TIMEOUT:
+                self.stop()
+                raise Exception('DeepFinder worker did not start in %d seconds.' % self.START_TIMEOUT)
+            time.sleep(0.5)
+        with open(self._addressFile) as f:
+            address = json.load(f)
+        self._address = (address['host'], address['port'])
+
+    def run(self, program, args, cwd=None):
+        """ Execute a DeepFinder program in the worker. An exception is raised if it fails, like with runJob. """
+        logger.info(cyanStr('DeepFinder worker job: %s %s' % (program, args)))
+        with self._lock:
+            if not self.isRunning():
+                raise Exception('DeepFinder worker is not running.')
+            with Client(self._address, authkey=self._authkey) as conn:
+                conn.send({'program': program, 'args': shlex.split(args), 'cwd': cwd})
+                result = conn.recv()
+        if result['status'] != 0:
+            raise Exception('DeepFinder program %s failed with exit code %s:\n%s' %
+                            (os.path.basename(program), result['status'], result['error']))
+
+    def stop(self):
+        """ Ask the worker to finish and wait for it. It is killed if it does not answer. """
+        with self._lock:
+            if not self.isRunning():
+                return
+            try:
+                with Client(self._address, authkey=self._authkey) as conn:
+                    conn.send({'stop': True})
+                    conn.recv()
+                self._process.wait(timeout=60)
+            except Exception as e:
+                logger.warning('DeepFinder worker did not stop cleanly (%s). Killing it.' % e)
+                self._process.kill()
+                self._process.wait()
+            finally:
+                if os.path.exists(self._addressFile):
+                    os.remove(self._addressFile)